@@ -1,30 +1,88 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import multiprocessing.pool
+import os
+import time
+
 import psycopg2
 import psycopg2.extras
 import requests
+import requests.adapters
 import json
 
 import mc_database
+import mc_retry
 import mediacloud
 
-def get_download_from_api( mc_api_url, api_key, downloads_id ):
-    
-    r = requests.get( mc_api_url +'/api/v2/downloads/single/' + str( downloads_id) , 
-                     params = { 'key': api_key} )
+# downloads exported concurrently, see --threads
+export_threads = 8
+
+# exports in flight or waiting to be checkpointed, per thread
+exports_per_thread = 4
+
+# downloads_ids read per query
+cursor_fetch_rows = 10000
+
+# seconds to wait for an API request
+request_timeout = 120
+
+# times a failed API request is retried, see request_with_retries() for which failures are retried
+max_retries = 5
+
+# seconds before the first retry of a request
+retry_backoff = 1.0
+
+# seconds between progress reports
+progress_interval = 30
+
+# seconds between checkpoint writes; downloads exported since the last one are exported again on resume
+checkpoint_interval = 1
+
+def api_session( pool_size ):
+    """requests.Session keeping up to pool_size connections to an API server alive"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter( pool_connections=1, pool_maxsize=pool_size )
+    session.mount( 'http://', adapter )
+    session.mount( 'https://', adapter )
+
+    return session
+
+def request_with_retries( session, method, url, idempotent=True, **kwargs ):
+    """Send a request, retrying connection errors, timeouts and server errors; raises for error responses
+
+    Requests that are not idempotent are only retried if the connection failed before the request
+    was sent; after a timeout or a server error the server may already have acted on it.
+    """
+    kwargs.setdefault( 'timeout', request_timeout )
+
+    def request():
+        r = session.request( method, url, **kwargs )
+        r.raise_for_status()
+        return r
+
+    return mc_retry.retry_with_backoff( request, mc_retry.is_transient_request_error, max_retries, retry_backoff,
+                                        method + ' ' + url, idempotent )
+
+def get_download_from_api( mc_api_url, api_key, downloads_id, session=requests ):
+
+    r = request_with_retries( session, 'GET', mc_api_url +'/api/v2/downloads/single/' + str( downloads_id) ,
+                              params = { 'key': api_key} )
     download = r.json()[0]
     return download
 
-def add_feed_download_with_api( mc_api_url, api_key, download, raw_content ):
-    r = requests.put( mc_api_url + '/api/v2/crawler/add_feed_download', 
-             params={  'key': api_key }, 
+def add_feed_download_with_api( mc_api_url, api_key, download, raw_content, session=requests ):
+    # every PUT adds a download, so it must not be repeated once it may have reached the server
+    r = request_with_retries( session, 'PUT', mc_api_url + '/api/v2/crawler/add_feed_download', idempotent=False,
+             params={  'key': api_key },
              data=json.dumps( { 'download': download, 'raw_content': raw_content } ),
              headers={ 'Accept': 'application/json'} )
 
     return r
 
-def export_feed_download( feed_downloads_id, source_media_cloud_api_url, source_api_key,  dest_media_cloud_api_url, dest_api_key ):
-    download = get_download_from_api( source_media_cloud_api_url, source_api_key, feed_downloads_id )
+def export_feed_download( feed_downloads_id, source_media_cloud_api_url, source_api_key,  dest_media_cloud_api_url, dest_api_key,
+                          source_session=requests, dest_session=requests ):
+    download = get_download_from_api( source_media_cloud_api_url, source_api_key, feed_downloads_id, source_session )
     #print download
     #break
     raw_content = download['raw_content' ]
@@ -32,36 +90,148 @@ def export_feed_download( feed_downloads_id, source_media_cloud_api_url, source_
 
     if download[ 'state' ] == 'feed_error':
         download[ 'state' ]  = 'success'
-    add_feed_download_with_api( dest_media_cloud_api_url, dest_api_key, download, raw_content )
+    add_feed_download_with_api( dest_media_cloud_api_url, dest_api_key, download, raw_content, dest_session )
+
+    return feed_downloads_id
+
+def read_checkpoint( checkpoint_file, export_settings ):
+    """Last downloads_id recorded in checkpoint_file, or 0 if there is none
+
+    export_settings describes the source, destination and database of this run. Raises an Exception
+    if the checkpoint was written by an export with different ones.
+    """
+    if not checkpoint_file or not os.path.exists( checkpoint_file ):
+        return 0
+
+    with open( checkpoint_file ) as f:
+        checkpoint = json.load( f )
+
+    if checkpoint[ 'export' ] != export_settings:
+        raise Exception( "checkpoint {} was written by a different export: {}".format( checkpoint_file, checkpoint[ 'export' ] ) )
 
+    return checkpoint[ 'downloads_id' ]
+
+def write_checkpoint( checkpoint_file, export_settings, downloads_id ):
+    if not checkpoint_file:
+        return
+
+    # written to a temporary file and renamed so that an interruption never leaves a partial checkpoint
+    temp_file = checkpoint_file + '.tmp'
+    with open( temp_file, 'w' ) as f:
+        json.dump( { 'export': export_settings, 'downloads_id': downloads_id }, f )
+        f.write( "\n" )
+    os.rename( temp_file, checkpoint_file )
+
+_feed_downloads_where = "type='feed' and state in ( 'success', 'feed_error') and downloads_id > %s"
+
+def iter_feed_downloads_ids( conn, after_downloads_id ):
+    """Generator of the ids of exportable feed downloads after after_downloads_id, in order
+
+    Ids are read cursor_fetch_rows at a time with keyset queries, committing after each page, so no
+    transaction is held open on the source database for the length of the export.
+    """
+    while True:
+        cursor = conn.cursor()
+        cursor.execute( "SELECT downloads_id from downloads where " + _feed_downloads_where + " order by downloads_id limit %s",
+                        ( after_downloads_id, cursor_fetch_rows ) )
+        downloads_ids = [ row[ 0 ] for row in cursor.fetchall() ]
+        cursor.close()
+        conn.commit()
+
+        if not downloads_ids:
+            break
+
+        for downloads_id in downloads_ids:
+            yield downloads_id
+
+        after_downloads_id = downloads_ids[ -1 ]
+
+def _format_duration( seconds ):
+    seconds = int( seconds )
+    return '{}:{:02d}:{:02d}'.format( seconds / 3600, ( seconds / 60 ) % 60, seconds % 60 )
+
+def main( source_media_cloud_api_url, dest_media_cloud_api_url, source_api_key, dest_api_key, db_label,
+          threads=None, checkpoint_file=None, resume=False ):
+    """Export the feed downloads of db_label from the source API to the destination API
+
+    Progress is recorded in checkpoint_file. With resume=True the export continues after the last
+    download it records, which must have been written by an export between the same source,
+    destination and database.
+    """
+    if threads is None:
+        threads = export_threads
 
-def main( source_media_cloud_api_url, dest_media_cloud_api_url, source_api_key, dest_api_key, db_label ):
     conn = mc_database.connect_to_database( db_label )
     cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-    print "fetching feed downloads from postgresql"
-    cursor.execute( "SELECT downloads_id from downloads where type='feed' and state in ( 'success', 'feed_error') order by downloads_id" )
-    feed_downloads = cursor.fetchall()
+    export_settings = { 'source': source_media_cloud_api_url, 'dest': dest_media_cloud_api_url, 'db_label': db_label }
 
-    feed_downloads_processed = 0
+    last_downloads_id = 0
+    if resume:
+        last_downloads_id = read_checkpoint( checkpoint_file, export_settings )
+        print "resuming after download", last_downloads_id
 
-    print "converting downloads_ids to int "
-    feed_downloads_ids = [ fd['downloads_id'] for fd in feed_downloads ]
+    print "counting feed downloads in postgresql"
+    cursor.execute( "SELECT count(*) from downloads where " + _feed_downloads_where, ( last_downloads_id, ) )
+    num_feed_downloads = cursor.fetchone()[ 0 ]
+    cursor.close()
 
+    print num_feed_downloads, "downloads to export "
 
-    print len( feed_downloads_ids ), "downloads to export "
-    
     print "exporting feed downloads with API"
 
-    for feed_downloads_id in feed_downloads_ids:
+    source_session = api_session( threads )
+    dest_session = api_session( threads )
+
+    def export( feed_downloads_id ):
+        return export_feed_download( feed_downloads_id, source_media_cloud_api_url, source_api_key,
+                                     dest_media_cloud_api_url, dest_api_key, source_session, dest_session )
+
+    feed_downloads_processed = 0
+    start_time = time.time()
+    last_report_time = start_time
+    last_checkpoint_time = start_time
+
+    def report():
+        elapsed = time.time() - start_time
+        rate = feed_downloads_processed / elapsed if elapsed > 0 else 0
+        eta = ( num_feed_downloads - feed_downloads_processed ) / rate if rate > 0 else 0
+        print "Processed {} downloads out of {}, {:.1f} per second, ETA {}".format(
+            feed_downloads_processed, num_feed_downloads, rate, _format_duration( eta ) )
+        print "last download ", last_downloads_id
+
+    pool = multiprocessing.pool.ThreadPool( threads )
+    try:
+        # results are taken in downloads_id order, so everything up to last_downloads_id has been exported
+        pending = collections.deque()
+        feed_downloads_ids = iter_feed_downloads_ids( conn, last_downloads_id )
+        while True:
+            for feed_downloads_id in feed_downloads_ids:
+                pending.append( pool.apply_async( export, ( feed_downloads_id, ) ) )
+                if len( pending ) >= threads * exports_per_thread:
+                    break
+
+            if not pending:
+                break
+
+            last_downloads_id = pending.popleft().get()
+            feed_downloads_processed += 1
+
+            if time.time() - last_checkpoint_time >= checkpoint_interval:
+                write_checkpoint( checkpoint_file, export_settings, last_downloads_id )
+                last_checkpoint_time = time.time()
 
-        export_feed_download( feed_downloads_id, source_media_cloud_api_url, source_api_key,  dest_media_cloud_api_url, dest_api_key )
+            if time.time() - last_report_time >= progress_interval:
+                report()
+                last_report_time = time.time()
+    finally:
+        pool.terminate()
+        pool.join()
 
-        feed_downloads_processed+= 1
+        write_checkpoint( checkpoint_file, export_settings, last_downloads_id )
+        report()
 
-        if feed_downloads_processed % 10 == 0:
-            print "Processed " + str( feed_downloads_processed ) + " downloads out of " + str( len( feed_downloads_ids ) )
-            print "last download ", feed_downloads_id
+    conn.close()
 
 import argparse
 
@@ -74,6 +244,11 @@ if __name__ == '__main__':
     parser.add_argument( '--source-media-cloud-api_url', required=True )
     parser.add_argument( '--dest-media-cloud-api_url', required=True )
     parser.add_argument( '--db-label', required=False, default=None )
+    parser.add_argument( '--threads', type=int, default=export_threads, help='downloads exported concurrently' )
+    parser.add_argument( '--checkpoint-file', default='export_feed_downloads.checkpoint',
+                         help='file recording the last exported downloads_id' )
+    parser.add_argument( '--resume', action='store_true',
+                         help='continue an interrupted export after the last download in --checkpoint-file' )
 
     args = parser.parse_args()
 
@@ -83,4 +258,5 @@ if __name__ == '__main__':
     dest_api_key = args.dest_api_key
     db_label = args.db_label
 
-    main ( source_media_cloud_api_url, dest_media_cloud_api_url, source_api_key, dest_api_key, db_label )
+    main ( source_media_cloud_api_url, dest_media_cloud_api_url, source_api_key, dest_api_key, db_label,
+           args.threads, args.checkpoint_file, args.resume )
@@ -2,6 +2,8 @@
 # A central location for extractor testing routines used in multiple notebooks
 #
 import mc_config
+import mc_database
+import mc_database_pool
 import psycopg2
 
 import psycopg2.extras
@@ -17,8 +19,11 @@ def get_db_info():
 def get_chloe_db_connection():
     db_info = get_db_info()
 
-    conn = psycopg2.connect( database=db_info['db'], user=db_info['user'], 
-                             password=db_info['pass'], host=db_info['host'], port=db_info['port'] )
+    conn = mc_database.connect_to_database( db_info=db_info )
 
     return conn
 
+def chloe_db_connection():
+    """Pooled connection to the same database as get_chloe_db_connection(), for use in a with block"""
+    return mc_database_pool.connection( db_info=get_db_info() )
+
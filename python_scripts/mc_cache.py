@@ -0,0 +1,81 @@
+#
+# Thread safe least recently used cache bounded by the total size of its values and by their age
+#
+import collections
+import threading
+import time
+
+class LruCache( object ):
+    """LRU cache bounded by the sum of sizeof( value ) over its entries and expiring them after ttl seconds
+
+    unit names the size measure in stats(), for example 'bytes' for a sizeof of len on strings.
+    """
+
+    def __init__( self, max_size, ttl, sizeof=len, unit='size' ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.unit = unit
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get( self, key ):
+        with self._lock:
+            entry = self._entries.pop( key, None )
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, size, stored_at = entry
+            if time.time() - stored_at > self.ttl:
+                self.size -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            # reinserting moves the key to the most recently used end
+            self._entries[ key ] = entry
+            self.hits += 1
+            return value
+
+    def put( self, key, value ):
+        size = self.sizeof( value )
+
+        with self._lock:
+            old_entry = self._entries.pop( key, None )
+            if old_entry is not None:
+                self.size -= old_entry[ 1 ]
+
+            if size > self.max_size:
+                return
+
+            self._entries[ key ] = ( value, size, time.time() )
+            self.size += size
+
+            while self.size > self.max_size:
+                evicted_key, ( evicted_value, evicted_size, stored_at ) = self._entries.popitem( last=False )
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def clear( self ):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats( self ):
+        with self._lock:
+            return {
+                'entries': len( self._entries ),
+                self.unit: self.size,
+                'max_' + self.unit: self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                }
@@ -1,7 +1,13 @@
 #!/usr/bin/python
  
 import yaml
+import collections
+import os
 import os.path
+import threading
+
+# the libyaml based loader is many times faster than the pure Python one
+_yaml_loader = getattr( yaml, 'CSafeLoader', yaml.SafeLoader )
 
 _config_file_base_name = 'mediawords.yml'
 _config_file_name = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'mediawords.yml'))
@@ -11,8 +17,8 @@ _defaults_config_file_name = os.path.abspath(os.path.join(os.path.dirname(__file
 
 
 def _load_yml( file_path ):
-    yml_file = open(file_path, 'rb')
-    config_file = yaml.load( yml_file )
+    with open(file_path, 'rb') as yml_file:
+        config_file = yaml.load( yml_file, Loader=_yaml_loader )
     
     return config_file
 
@@ -25,7 +31,58 @@ def deep_merge( original, update ):
 
     return original
 
+class FrozenDict( collections.Mapping ):
+    """Read only view of a dict whose nested dicts and lists are frozen as well"""
+
+    def __init__( self, values ):
+        self._values = { key: freeze( value ) for key, value in values.iteritems() }
+
+    def __getitem__( self, key ):
+        return self._values[ key ]
+
+    def __iter__( self ):
+        return iter( self._values )
+
+    def __len__( self ):
+        return len( self._values )
+
+    def __repr__( self ):
+        return 'FrozenDict({!r})'.format( self._values )
+
+def freeze( value ):
+    """Immutable copy of value, with dicts as FrozenDicts and lists as tuples"""
+    if isinstance( value, dict ):
+        return FrozenDict( value )
+    elif isinstance( value, ( list, tuple ) ):
+        return tuple( freeze( item ) for item in value )
+
+    return value
+
+_cached_config = None
+
+_cached_mtimes = None
+
+_cache_lock = threading.Lock()
+
+def _config_mtimes():
+    return tuple( os.stat( file_name ).st_mtime for file_name in ( _config_file_name, _defaults_config_file_name ) )
+
 def read_config():
+    """The merged configuration as a FrozenDict
+
+    The files are parsed once and parsed again only when one of them has been modified.
+    """
+    global _cached_config, _cached_mtimes
+
+    with _cache_lock:
+        mtimes = _config_mtimes()
+        if _cached_config is None or mtimes != _cached_mtimes:
+            _cached_config = freeze( _read_config_files() )
+            _cached_mtimes = mtimes
+
+        return _cached_config
+
+def _read_config_files():
     
     config_file   = _load_yml( _config_file_name )
     defaults_file = _load_yml( _defaults_config_file_name )
@@ -18,7 +18,24 @@ def get_db_info( db_label=None):
 
     return ret
 
-def connect_to_database( db_label=None ):
-    db_info = get_db_info( db_label)
-    conn = psycopg2.connect( database=db_info['db'], user=db_info['user'], password=db_info['pass'], host=db_info['host'], port=db_info['port'] )
+def connection_args( db_label=None, db_info=None ):
+    """Keyword arguments of psycopg2.connect() for db_label, or for the database entry db_info if given
+
+    mediawords.db_statement_timeout, in milliseconds, is applied to every connection as it is by
+    MediaWords::DB.
+    """
+    if db_info is None:
+        db_info = get_db_info( db_label)
+
+    args = { 'database': db_info['db'], 'user': db_info['user'], 'password': db_info['pass'], 'host': db_info['host'], 'port': db_info['port'] }
+
+    statement_timeout = mc_config.read_config()['mediawords'].get( 'db_statement_timeout' )
+    if statement_timeout:
+        args[ 'options' ] = '-c statement_timeout={}'.format( int( statement_timeout ) )
+
+    return args
+
+def connect_to_database( db_label=None, db_info=None ):
+    """A connection of its own for long running work, see mc_database_pool for short queries"""
+    conn = psycopg2.connect( **connection_args( db_label, db_info ) )
     return conn
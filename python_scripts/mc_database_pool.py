@@ -0,0 +1,140 @@
+#
+# Thread safe pools of PostgreSQL connections, one per database in mediawords.yml
+#
+import contextlib
+import threading
+import time
+
+import psycopg2
+
+import mc_database
+
+# connections a pool opens at most; further checkouts wait for one to be returned
+max_connections = 20
+
+# connections idle for longer than this many seconds are checked with a query before being handed out
+health_check_interval = 30
+
+class ConnectionPool( object ):
+    """Pool of connections to a single database
+
+    Returned connections are kept open, up to max_connections of them, and reused most recently
+    returned first. checkout() blocks while all max_connections connections are in use. Connections
+    that were idle for a while are checked before use and replaced if the server has gone away.
+    """
+
+    def __init__( self, db_label=None, maxconn=None, db_info=None ):
+        if maxconn is None:
+            maxconn = max_connections
+
+        self.db_label = db_label
+        self._connection_args = mc_database.connection_args( db_label, db_info )
+        self._available = threading.BoundedSemaphore( maxconn )
+
+        # ( connection, time it was returned ) pairs
+        self._idle = []
+        self._idle_lock = threading.Lock()
+
+    def _is_healthy( self, conn, last_used ):
+        if conn.closed:
+            return False
+
+        if time.time() - last_used < health_check_interval:
+            return True
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute( 'select 1' )
+            cursor.close()
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+
+        return True
+
+    def _getconn( self ):
+        while True:
+            with self._idle_lock:
+                if not self._idle:
+                    break
+
+                conn, last_used = self._idle.pop()
+
+            if self._is_healthy( conn, last_used ):
+                return conn
+
+            if not conn.closed:
+                conn.close()
+
+        return psycopg2.connect( **self._connection_args )
+
+    def _putconn( self, conn ):
+        if conn.closed:
+            return
+
+        with self._idle_lock:
+            self._idle.append( ( conn, time.time() ) )
+
+    @contextlib.contextmanager
+    def checkout( self ):
+        """Context manager lending out a connection
+
+        The transaction is committed when the block succeeds and rolled back if it raises.
+        """
+        self._available.acquire()
+        try:
+            conn = self._getconn()
+            try:
+                yield conn
+
+                if not conn.closed:
+                    conn.commit()
+            except:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                self._putconn( conn )
+        finally:
+            self._available.release()
+
+    def close( self ):
+        with self._idle_lock:
+            idle = self._idle
+            self._idle = []
+
+        for conn, last_used in idle:
+            if not conn.closed:
+                conn.close()
+
+_pools = {}
+
+_pools_lock = threading.Lock()
+
+def _pool_key( db_label, db_info ):
+    if db_info is None:
+        return db_label
+
+    return ( db_info[ 'host' ], db_info[ 'port' ], db_info[ 'db' ], db_info[ 'user' ] )
+
+def get_pool( db_label=None, db_info=None ):
+    """The process wide pool for db_label, or for the database entry db_info, created on first use"""
+    key = _pool_key( db_label, db_info )
+
+    with _pools_lock:
+        pool = _pools.get( key )
+        if pool is None:
+            pool = _pools[ key ] = ConnectionPool( db_label, db_info=db_info )
+
+        return pool
+
+def connection( db_label=None, db_info=None ):
+    """Check out a pooled connection to db_label: with mc_database_pool.connection() as conn: ..."""
+    return get_pool( db_label, db_info ).checkout()
+
+def close_all():
+    with _pools_lock:
+        for pool in _pools.itervalues():
+            pool.close()
+
+        _pools.clear()
@@ -0,0 +1,122 @@
+#
+# Minimal in process metrics: counters and histograms with labels, rendered in the Prometheus text
+# exposition format
+#
+import bisect
+import collections
+import contextlib
+import threading
+import time
+
+_default_buckets = ( 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0 )
+
+_registry = collections.OrderedDict()
+_registry_lock = threading.Lock()
+
+def _label_key( labels ):
+    return tuple( sorted( labels.items() ) )
+
+def _format_labels( label_key, extra=() ):
+    pairs = list( label_key ) + list( extra )
+    if not pairs:
+        return ''
+
+    return '{' + ','.join( '{}="{}"'.format( name, str( value ).replace( '\\', '\\\\' ).replace( '"', '\\"' ) )
+                           for name, value in pairs ) + '}'
+
+def _format_value( value ):
+    if value == float( 'inf' ):
+        return '+Inf'
+
+    return repr( float( value ) ) if isinstance( value, float ) else str( value )
+
+class Counter( object ):
+    type = 'counter'
+
+    def __init__( self, name, help ):
+        self.name = name
+        self.help = help
+        self._values = collections.defaultdict( int )
+        self._lock = threading.Lock()
+
+    def inc( self, amount=1, **labels ):
+        with self._lock:
+            self._values[ _label_key( labels ) ] += amount
+
+    def samples( self ):
+        with self._lock:
+            return [ ( self.name, label_key, value ) for label_key, value in sorted( self._values.items() ) ]
+
+class Histogram( object ):
+    type = 'histogram'
+
+    def __init__( self, name, help, buckets=_default_buckets ):
+        self.name = name
+        self.help = help
+        self.buckets = tuple( sorted( buckets ) )
+        self._counts = {}
+        self._sums = collections.defaultdict( float )
+        self._lock = threading.Lock()
+
+    def observe( self, value, **labels ):
+        label_key = _label_key( labels )
+        with self._lock:
+            counts = self._counts.get( label_key )
+            if counts is None:
+                counts = self._counts[ label_key ] = [ 0 ] * ( len( self.buckets ) + 1 )
+
+            counts[ bisect.bisect_left( self.buckets, value ) ] += 1
+            self._sums[ label_key ] += value
+
+    def samples( self ):
+        ret = []
+        with self._lock:
+            for label_key, counts in sorted( self._counts.items() ):
+                cumulative = 0
+                for upper_bound, count in zip( self.buckets + ( float( 'inf' ), ), counts ):
+                    cumulative += count
+                    ret.append( ( self.name + '_bucket', label_key + ( ( 'le', _format_value( upper_bound ) ), ), cumulative ) )
+
+                ret.append( ( self.name + '_sum', label_key, self._sums[ label_key ] ) )
+                ret.append( ( self.name + '_count', label_key, cumulative ) )
+
+        return ret
+
+def _get_or_create( metric_class, name, *args ):
+    with _registry_lock:
+        metric = _registry.get( name )
+        if metric is None:
+            metric = _registry[ name ] = metric_class( name, *args )
+
+        return metric
+
+def counter( name, help ):
+    """Return the counter registered as name, creating it if needed"""
+    return _get_or_create( Counter, name, help )
+
+def histogram( name, help, buckets=_default_buckets ):
+    """Return the histogram registered as name, creating it if needed"""
+    return _get_or_create( Histogram, name, help, buckets )
+
+@contextlib.contextmanager
+def timer( histogram, **labels ):
+    """Observe the number of seconds spent in the with block in histogram"""
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        histogram.observe( time.time() - start_time, **labels )
+
+def render_prometheus():
+    """All registered metrics in the Prometheus text exposition format"""
+    with _registry_lock:
+        metrics = _registry.values()
+
+    lines = []
+    for metric in metrics:
+        lines.append( '# HELP {} {}'.format( metric.name, metric.help ) )
+        lines.append( '# TYPE {} {}'.format( metric.name, metric.type ) )
+        for name, label_key, value in metric.samples():
+            lines.append( '{}{} {}'.format( name, _format_labels( label_key ), _format_value( value ) ) )
+
+    return "\n".join( lines ) + "\n"
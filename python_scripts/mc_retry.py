@@ -0,0 +1,53 @@
+#
+# Retrying of failed requests with exponential backoff
+#
+import errno
+import socket
+import sys
+import time
+
+import requests
+import requests.packages.urllib3.exceptions
+
+def is_transient_request_error( error ):
+    """True for request errors worth retrying: connection errors, timeouts and server side 5xx responses"""
+    if isinstance( error, ( requests.exceptions.ConnectionError, requests.exceptions.Timeout ) ):
+        return True
+
+    response = getattr( error, 'response', None )
+    return isinstance( error, requests.exceptions.HTTPError ) and response is not None and response.status_code >= 500
+
+def request_not_sent( error ):
+    """True if a requests ConnectionError or Timeout was raised before the request reached the server"""
+    if not isinstance( error, ( requests.exceptions.ConnectionError, requests.exceptions.Timeout ) ):
+        return False
+
+    # the adapter wraps urllib3's error, or the MaxRetryError whose reason is the error of the last attempt
+    reason = error.args[ 0 ] if error.args else None
+    reason = getattr( reason, 'reason', reason )
+
+    # a timeout while connecting, or a connection refused or unroutable, leave nothing for the server to act on
+    if isinstance( reason, requests.packages.urllib3.exceptions.ConnectTimeoutError ):
+        return True
+
+    return isinstance( reason, socket.error ) and reason.errno in ( errno.ECONNREFUSED, errno.ENETUNREACH, errno.EHOSTUNREACH )
+
+def retry_with_backoff( function, is_transient, retries, backoff, description, idempotent=True ):
+    """Return function(), calling it again while it raises an error is_transient( error ) accepts
+
+    The first retry waits backoff seconds and every further one twice as long as the one before. After
+    retries retries the last error is raised. A function that is not idempotent is only called again
+    if the request it made was never sent, as the server may already have acted on it otherwise.
+    """
+    attempt = 0
+    while True:
+        try:
+            return function()
+        except Exception as e:
+            if attempt >= retries or not is_transient( e ) or not ( idempotent or request_not_sent( e ) ):
+                raise
+
+            delay = backoff * ( 2 ** attempt )
+            print >> sys.stderr, "{} failed ({}), retrying in {} seconds".format( description, e, delay )
+            time.sleep( delay )
+            attempt += 1
@@ -1,59 +1,176 @@
 import requests
+import requests.adapters
 import mc_config
-import psycopg2
-import psycopg2.extras
+import mc_retry
+import threading
 import time
 import json
 import pysolr
 import sys
 
-def py_solr_connection():
-    solr = pysolr.Solr(get_solr_collection_url_prefix(), timeout=300)
-    
-    return solr
+# seconds to wait for Solr to answer a request
+request_timeout = 300
 
-def get_solr_collection_url_prefix():
-    config = mc_config.read_config()
+# times a failed request is retried; only GETs are retried unless the request was never sent
+max_retries = 3
 
-    #print >> sys.stderr, config
+# seconds before the first retry
+retry_backoff = 0.5
 
-    solr_collection_url = config['mediawords'][ 'solr_url' ][0] + '/collection1'
+# connections kept alive per client; the shared client serves every thread of the word count server, each of
+# which may fetch several shards at once
+default_pool_size = 64
 
-    return solr_collection_url
+# ask Solr for gzip compressed responses
+default_gzip = True
 
-def solr_request( path, params):
-    url = get_solr_collection_url_prefix() + '/' + path
-    print 'url: {}'.format( url )
-    params['wt'] = 'json'
-    r = requests.get( url, params=params, headers = { 'Accept': 'application/json'}) 
-    print 'request url '
-    print r.url
+class SolrClient( object ):
+    """HTTP client for Solr with a pool of keep-alive connections, timeouts and retries
 
-    data = r.json()
+    A single client is safe to share between threads.
+    """
 
-    return data
+    def __init__( self, timeout=None, retries=None, backoff=None, pool_size=None, gzip=None ):
+        self.timeout = request_timeout if timeout is None else timeout
+        self.retries = max_retries if retries is None else retries
+        self.backoff = retry_backoff if backoff is None else backoff
 
-def _solr_post( path, params, payload):
-    url = get_solr_collection_url_prefix() + '/' + path
-    print 'url: {}'.format( url )
+        if pool_size is None:
+            pool_size = default_pool_size
+        if gzip is None:
+            gzip = default_gzip
+
+        self.session = requests.Session()
+        self.session.headers[ 'Accept-Encoding' ] = 'gzip' if gzip else 'identity'
+
+        adapter = requests.adapters.HTTPAdapter( pool_connections=1, pool_maxsize=pool_size )
+        self.session.mount( 'http://', adapter )
+        self.session.mount( 'https://', adapter )
+
+    def send( self, method, url, idempotent=None, **kwargs ):
+        """Send a request with session.request(), retrying transient failures; returns the response
+
+        Requests that are not idempotent, by default anything but GETs, are only retried if they were never sent.
+        """
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method == 'GET'
+
+        kwargs.setdefault( 'timeout', self.timeout )
+
+        def request():
+            resp = self.session.request( method, url, **kwargs )
+            if resp.status_code >= 500:
+                resp.raise_for_status()
+            return resp
+
+        try:
+            return mc_retry.retry_with_backoff( request, mc_retry.is_transient_request_error, self.retries, self.backoff,
+                                                method + ' ' + url, idempotent )
+        except requests.exceptions.HTTPError as err:
+            return err.response
+
+    def get_json( self, path, params=None, idempotent=True ):
+        """GET path relative to the collection URL and decode the JSON response"""
+        params = dict( params or {} )
+        params[ 'wt' ] = 'json'
+
+        r = self.send( 'get', get_solr_collection_url_prefix() + '/' + path, idempotent, params=params,
+                       headers={ 'Accept': 'application/json' } )
+
+        return r.json()
+
+    def post_json( self, path, params, payload ):
+        """POST payload as JSON to path relative to the collection URL and decode the JSON response"""
+        r = self.send( 'post', get_solr_collection_url_prefix() + '/' + path, data=json.dumps( payload ), params=params,
+                       headers={ 'Accept': 'application/json', 'Content-type': 'application/json; charset=utf-8' } )
+
+        return r.json()
+
+_client = None
+
+_client_lock = threading.Lock()
+
+def get_client():
+    """The process wide SolrClient, created on first use"""
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            _client = SolrClient()
 
-    r = requests.post( url, data=json.dumps(payload), params=params, headers = { 'Accept': 'application/json', 'Content-type': 'application/json; charset=utf-8' } )
-    print 'request url '
-    print r.url
+        return _client
 
-    data = r.json()
+class PooledSolr( pysolr.Solr ):
+    """pysolr client that sends its requests through a SolrClient
 
-    return data
+    pysolr opens a new connection for every request and never retries. The shared client keeps
+    connections alive, so that many threads and connections can use it at once.
+    """
+
+    def __init__( self, url, decoder=None, timeout=None, client=None ):
+        if client is None:
+            client = get_client()
+
+        super( PooledSolr, self ).__init__( url, decoder=decoder, timeout=client.timeout if timeout is None else timeout )
+
+        self.client = client
+
+    def _send_request( self, method, path='', body=None, headers=None, files=None ):
+        url = self._create_full_url( path )
+
+        if body is not None:
+            body = pysolr.force_bytes( body )
+
+        try:
+            resp = self.client.send( method, url, data=body, headers=headers, files=files, timeout=self.timeout )
+        except requests.exceptions.RequestException as err:
+            raise pysolr.SolrError( "Request to '{}' failed: {}".format( url, err ) )
+
+        if int( resp.status_code ) != 200:
+            raise pysolr.SolrError( self._extract_error( resp ) )
+
+        return pysolr.force_unicode( resp.content )
+
+def pooled_solr_connection( url=None, timeout=None, pool_size=None ):
+    """PooledSolr client for url, the configured collection by default
+
+    Connections share the process wide client unless a pool_size of their own is asked for.
+    """
+    if url is None:
+        url = get_solr_collection_url_prefix()
+
+    client = None
+    if pool_size is not None:
+        client = SolrClient( pool_size=pool_size )
+
+    return PooledSolr( url, timeout=timeout, client=client )
+
+def py_solr_connection():
+    return pooled_solr_connection()
+
+def get_solr_collection_url_prefix():
+    # read_config() is cached and picks up changes to mediawords.yml
+    return mc_config.read_config()['mediawords'][ 'solr_url' ][0] + '/collection1'
+
+def solr_request( path, params, idempotent=True ):
+    return get_client().get_json( path, params, idempotent )
+
+def _solr_post( path, params, payload):
+    return get_client().post_json( path, params, payload )
 
 def delete_all_documents():
     _solr_post( 'update', { 'commit': 'true'}, {'delete': {'query': '*:*'}} )
 
-def dataimport_command( command, params={}):
+def dataimport_command( command, params=None, idempotent=False ):
+    params = dict( params or {} )
     params['command'] = command
-    return solr_request( 'dataimport', params )
+
+    # commands such as a clean full-import must not be started twice, so only status requests are retried
+    return solr_request( 'dataimport', params, idempotent )
 
 def dataimport_status():
-    return dataimport_command( 'status' )
+    return dataimport_command( 'status', idempotent=True )
 
 def dataimport_delta_import():
     params = {
@@ -3,8 +3,14 @@
 
 from prompter import yesno
 
+import collections
+import multiprocessing.pool
+import Queue
 import sys
+import threading
+import time
 import mc_database
+import mc_retry
 
 import psycopg2
 import psycopg2.extras
@@ -12,6 +18,35 @@ import psycopg2.extras
 import mediacloud, json
 import argparse
 
+# rows sent per INSERT and per commit, see --batch-size
+insert_batch_size = 1000
+
+# threads fetching feed lists from the API, see --feed-threads
+feed_fetch_threads = 8
+
+# API calls started per second over all threads, see --requests-per-second
+api_requests_per_second = 10.0
+
+# times an API call failing with a connection error, a timeout or a 5xx response is retried
+api_max_retries = 3
+
+# seconds before the first retry of an API call
+api_retry_backoff = 1.0
+
+# pages of media fetched ahead of the database writer
+media_pages_prefetched = 4
+
+# feed list requests in flight or waiting to be written, per feed fetch thread
+feed_requests_per_thread = 2
+
+# database_variables holding the progress of an import, committed with the rows they describe
+last_tag_sets_id_var = 'MEDIA_IMPORT_LAST_TAG_SETS_ID'
+last_media_id_var = 'MEDIA_IMPORT_LAST_MEDIA_ID'
+last_feeds_media_id_var = 'MEDIA_IMPORT_LAST_FEEDS_MEDIA_ID'
+
+# table holding the dup_media_id of media whose duplicate is not imported yet, committed with the media
+pending_dup_media_ids_table = 'media_import_pending_dup_media_ids'
+
 def cast_fields_to_bool( dict_obj, fields ):
     for field in fields:
         if dict_obj[ field ] is not None:
@@ -22,15 +57,126 @@ def non_list_pairs( item ):
     item = { k: item[k]  for k in  item.keys() if type(item[k]) != list  }
     return item
 
-def insert_into_table( cursor, table_name, item ):
-    item = { k: item[k]  for k in  item.keys() if type(item[k]) != list  }
-    columns = ', '.join(item.keys())
-    
-    placeholders = ', '.join([ '%('+ c + ')s'  for c in item.keys() ])
-    
-    query = "insert into " + table_name + " (%s) Values (%s)" %( columns, placeholders)
-    #print query
-    cursor.execute( query , item )
+def insert_rows( cursor, table_name, items, key=None ):
+    """Insert items with one multi-row INSERT per distinct set of columns, skipping list fields
+
+    If key is given, items whose key column value is already in the table are skipped, so that
+    inserting the same batch twice is harmless.
+    """
+    if key is not None:
+        cursor.execute( "select " + key + " from " + table_name + " where " + key + " = any( %s )",
+                        ( [ item[ key ] for item in items ], ) )
+        existing = set( row[ 0 ] for row in cursor.fetchall() )
+        items = [ item for item in items if item[ key ] not in existing ]
+
+    rows_by_columns = collections.OrderedDict()
+    for item in items:
+        item = non_list_pairs( item )
+        columns = tuple( sorted( item.keys() ) )
+        rows_by_columns.setdefault( columns, [] ).append( tuple( item[ c ] for c in columns ) )
+
+    for columns, rows in rows_by_columns.iteritems():
+        query = "insert into " + table_name + " (%s) Values %%s" % ', '.join( columns )
+        psycopg2.extras.execute_values( cursor, query, rows, page_size=len( rows ) )
+
+class BatchInserter( object ):
+    """Buffers rows for table_name, inserting and committing them batch_size at a time
+
+    Rows whose key already exists are skipped. on_flush( cursor, items ) is called before each batch
+    is inserted, within the same transaction.
+    """
+
+    def __init__( self, conn, table_name, batch_size=None, key=None, on_flush=None ):
+        self.conn = conn
+        self.table_name = table_name
+        self.batch_size = batch_size or insert_batch_size
+        self.key = key
+        self.on_flush = on_flush
+        self.rows_inserted = 0
+        self._items = []
+
+    def add( self, item ):
+        self._items.append( item )
+
+        if len( self._items ) >= self.batch_size:
+            self.flush()
+
+    def flush( self ):
+        if not self._items:
+            return
+
+        cursor = self.conn.cursor()
+        if self.on_flush is not None:
+            self.on_flush( cursor, self._items )
+        insert_rows( cursor, self.table_name, self._items, self.key )
+        cursor.close()
+        self.conn.commit()
+
+        self.rows_inserted += len( self._items )
+        self._items = []
+
+def get_checkpoint( conn, name ):
+    """Integer value of the database variable name, or None if it is not set"""
+    cursor = conn.cursor()
+    cursor.execute( "select value from database_variables where name = %s", ( name, ) )
+    row = cursor.fetchone()
+    cursor.close()
+
+    return int( row[ 0 ] ) if row is not None else None
+
+def set_checkpoint( cursor, name, value ):
+    cursor.execute( "update database_variables set value = %s where name = %s", ( str( value ), name ) )
+    if cursor.rowcount == 0:
+        cursor.execute( "insert into database_variables ( name, value ) Values ( %s, %s )", ( name, str( value ) ) )
+
+def clear_checkpoints( conn ):
+    cursor = conn.cursor()
+    cursor.execute( "delete from database_variables where name like %s", ( 'MEDIA\\_IMPORT\\_%', ) )
+    cursor.execute( "drop table if exists " + pending_dup_media_ids_table )
+    cursor.close()
+    conn.commit()
+
+def _checkpoint_tag_sets( cursor, tag_sets ):
+    set_checkpoint( cursor, last_tag_sets_id_var, tag_sets[ -1 ][ 'tag_sets_id' ] )
+
+def _create_pending_dup_media_ids_table( cursor ):
+    cursor.execute( "create table if not exists " + pending_dup_media_ids_table +
+                    " ( media_id int primary key, dup_media_id int not null )" )
+
+def _checkpoint_media( cursor, media ):
+    # duplicates of media imported earlier are linked at once; links to media still to come are kept
+    # in pending_dup_media_ids_table until set_dup_media_ids()
+    cursor.execute( "SET CONSTRAINTS media_dup_media_id_fkey DEFERRED " )
+
+    pending = []
+    for medium in media:
+        if medium.get( 'dup_media_id' ) is not None and medium[ 'dup_media_id' ] > medium[ 'media_id' ]:
+            pending.append( ( medium[ 'media_id' ], medium[ 'dup_media_id' ] ) )
+            medium[ 'dup_media_id' ] = None
+
+    if pending:
+        _create_pending_dup_media_ids_table( cursor )
+        cursor.execute( "delete from " + pending_dup_media_ids_table + " where media_id = any( %s )",
+                        ( [ media_id for media_id, dup_media_id in pending ], ) )
+        psycopg2.extras.execute_values( cursor,
+            "insert into " + pending_dup_media_ids_table + " ( media_id, dup_media_id ) Values %s", pending,
+            page_size=len( pending ) )
+
+    set_checkpoint( cursor, last_media_id_var, media[ -1 ][ 'media_id' ] )
+
+def set_dup_media_ids( conn ):
+    """Link the media whose duplicate had not been imported when they were inserted, in a single UPDATE"""
+    cursor = conn.cursor()
+    _create_pending_dup_media_ids_table( cursor )
+    cursor.execute( "update media set dup_media_id = p.dup_media_id from " + pending_dup_media_ids_table + " as p " +
+                    "where media.media_id = p.media_id" )
+    num_linked = cursor.rowcount
+
+    cursor.execute( "drop table " + pending_dup_media_ids_table )
+    cursor.close()
+    conn.commit()
+
+    return num_linked
 
 
 def update_db_sequences( conn ):
@@ -58,138 +204,282 @@ def truncate_tables( conn ):
     cursor.execute( "TRUNCATE feeds CASCADE" )
     conn.commit()
 
-def get_tag_sets( mc ):
-    all_tag_sets = []
+def iter_tag_sets( mc, rate_limiter=None, last_tag_sets_id=0 ):
+    """Generator of the tag sets after last_tag_sets_id, fetched a page at a time"""
+    if rate_limiter is None:
+        rate_limiter = RateLimiter( api_requests_per_second )
 
-    last_tag_sets_id = 0
-    
     while True:
-        tag_sets = mc.tagSetList( last_tag_sets_id=last_tag_sets_id, rows=20)
+        tag_sets = call_api( rate_limiter, mc.tagSetList, last_tag_sets_id=last_tag_sets_id, rows=20 )
         if len(tag_sets) == 0:
             break
         
-        #print tag_sets
         last_tag_sets_id = tag_sets[-1]['tag_sets_id']
-        #print last_tag_sets_id
     
-         
-        all_tag_sets.extend(tag_sets)
-        
-    return all_tag_sets   
+        for tag_set in tag_sets:
+            yield tag_set
 
-
-def add_tag_sets_to_database( conn, all_tag_sets ):
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+def add_tag_sets_to_database( conn, all_tag_sets, batch_size=None ):
+    inserter = BatchInserter( conn, 'tag_sets', batch_size, key='tag_sets_id', on_flush=_checkpoint_tag_sets )
     for tag_set in all_tag_sets:
         cast_fields_to_bool( tag_set, [ 'show_on_media', 'show_on_stories' ] )
-        insert_into_table( cursor, 'tag_sets', tag_set )
-        print 'inserted ' + tag_set['name']
-    conn.commit()    
+        inserter.add( tag_set )
 
+    inserter.flush()
+    print 'inserted ' + str( inserter.rows_inserted ) + ' tag sets'
 
-def add_media_to_database( conn, all_media ):
-    
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cursor.execute( "SET CONSTRAINTS media_dup_media_id_fkey DEFERRED ") 
-    
-    num_media_inserted = 0
-    
-    for medium in all_media:
-        medium = non_list_pairs( medium)
-        #del medium['dup_media_id']
-        cast_fields_to_bool( medium, [ 'extract_author', "full_text_rss", "foreign_rss_links",
-            "moderated", "use_pager", "is_not_dup"])
-        insert_into_table( cursor, 'media', medium )
-        
-        num_media_inserted += 1
-        
-        if num_media_inserted % 500 == 0:
-            print "Inserted " + str( num_media_inserted ) + " out of " + str(len(all_media) )
-            
-        #print 'inserted '
-        
-    conn.commit()
-    cursor.close()
-    conn.commit()
 
-def get_media( mc ):
-    all_media = []
+def prepare_medium( medium ):
+    """Copy of medium ready for insertion"""
+    medium = non_list_pairs( medium)
+    cast_fields_to_bool( medium, [ 'extract_author', "full_text_rss", "foreign_rss_links",
+        "moderated", "use_pager", "is_not_dup"])
+
+    return medium
+
+def media_inserter( conn, batch_size=None ):
+    """BatchInserter for media sorted by media_id, checkpointing and deferring duplicates"""
+    return BatchInserter( conn, 'media', batch_size, key='media_id', on_flush=_checkpoint_media )
+
+def iter_media_pages( mc, rate_limiter=None, last_media_id=0 ):
+    """Generator of the pages of the media after last_media_id"""
+    if rate_limiter is None:
+        rate_limiter = RateLimiter( api_requests_per_second )
 
-    last_media_id = 0
-    
     while True:
-        media = mc.mediaList( last_media_id=last_media_id, rows=1000)
-        print last_media_id, len( media ), len( all_media )
+        media = call_api( rate_limiter, mc.mediaList, last_media_id=last_media_id, rows=1000 )
+        print last_media_id, len( media )
     
         if len(media) == 0:
             break
             
         last_media_id = media[-1]['media_id']
-        last_media_id
-        
-        all_media.extend(media)
         
-        #if len( all_media ) > 10000:
-        #    break
-    
-    return all_media
+        yield media
 
-def add_feeds_from_media_to_database( conn, mc, media ):
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+def prefetch( iterable, max_items ):
+    """Iterate over iterable in a background thread, keeping at most max_items ready for the caller"""
+    items = Queue.Queue( max_items )
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put( ( item, None ) )
+            items.put( ( done, None ) )
+        except Exception:
+            items.put( ( done, sys.exc_info() ) )
+
+    thread = threading.Thread( target=produce )
+    thread.daemon = True
+    thread.start()
+
+    while True:
+        item, exc_info = items.get()
+        if item is done:
+            if exc_info is not None:
+                raise exc_info[ 0 ], exc_info[ 1 ], exc_info[ 2 ]
+            return
+
+        yield item
+
+class RateLimiter( object ):
+    """Spaces calls to wait() from any number of threads at least 1 / rate seconds apart"""
+
+    def __init__( self, rate ):
+        self.interval = 1.0 / rate if rate else 0
+        self._next_time = 0
+        self._lock = threading.Lock()
+
+    def wait( self ):
+        with self._lock:
+            now = time.time()
+            start_time = max( now, self._next_time )
+            self._next_time = start_time + self.interval
+
+        if start_time > now:
+            time.sleep( start_time - now )
+
+def is_transient_api_error( e ):
+    """True for API errors worth retrying: connection errors, timeouts and server side 5xx responses
+
+    The API client raises MCException with the HTTP status_code for other failed requests, such as a
+    bad key, which retrying cannot fix.
+    """
+    if mc_retry.is_transient_request_error( e ):
+        return True
+
+    status_code = getattr( e, 'status_code', None )
+    return status_code is not None and status_code >= 500
+
+def call_api( rate_limiter, function, *args, **kwargs ):
+    """Call an API client method within the rate limit, retrying transient failures with backoff"""
+    def call():
+        rate_limiter.wait()
+        return function( *args, **kwargs )
+
+    return mc_retry.retry_with_backoff( call, is_transient_api_error, api_max_retries, api_retry_backoff, 'API call' )
+
+def fetch_feeds( mc, media, threads=None, requests_per_second=None, rate_limiter=None ):
+    """Generator of ( medium, feeds ) pairs in the order of media, fetched by a pool of threads
+
+    media is consumed lazily, feed_requests_per_thread media per thread ahead of the caller.
+    """
+    if threads is None:
+        threads = feed_fetch_threads
+    if requests_per_second is None:
+        requests_per_second = api_requests_per_second
+
+    if rate_limiter is None:
+        rate_limiter = RateLimiter( requests_per_second )
+
+    def fetch( medium ):
+        return medium, call_api( rate_limiter, mc.feedList, media_id=medium['media_id'], rows=1000 )
+
+    pool = multiprocessing.pool.ThreadPool( threads )
+    try:
+        pending = collections.deque()
+        for medium in media:
+            pending.append( pool.apply_async( fetch, ( medium, ) ) )
+
+            if len( pending ) >= threads * feed_requests_per_thread:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def add_feeds_from_media_to_database( conn, mc, media, batch_size=None, threads=None, requests_per_second=None,
+                                      rate_limiter=None ):
+    """Import the feeds of media, which must be sorted by media_id
+
+    The last medium whose feeds have all been committed is checkpointed with every batch.
+    """
+    # last medium whose feeds have all been added to the inserter
+    completed_media_id = [ None ]
+
+    def checkpoint( cursor, feeds=None ):
+        if completed_media_id[ 0 ] is not None:
+            set_checkpoint( cursor, last_feeds_media_id_var, completed_media_id[ 0 ] )
+
+    inserter = BatchInserter( conn, 'feeds', batch_size, key='feeds_id', on_flush=checkpoint )
     
     num_media_processed = 0
     
-    for medium in media:
-        feeds_for_media = mc.feedList( media_id=medium['media_id'], rows=1000)
+    for medium, feeds_for_media in fetch_feeds( mc, media, threads, requests_per_second, rate_limiter ):
         assert len( feeds_for_media ) < 10000
         
         for feed in feeds_for_media:
             cast_fields_to_bool( feed, [ 'skip_bitly_processing' ])
-            insert_into_table( cursor, 'feeds', feed )
+            inserter.add( feed )
             
+        completed_media_id[ 0 ] = medium['media_id']
         num_media_processed += 1
         
         if num_media_processed % 1000 == 0:
-            print "inserted feeds for " + str( num_media_processed ) + " out of " + str ( len( media ) )
+            print "inserted feeds for " + str( num_media_processed ) + " media"
     
+    inserter.flush()
+
+    cursor = conn.cursor()
+    checkpoint( cursor )
+    cursor.close()
     conn.commit()
+
+def _media_without_feeds( conn, last_feeds_media_id, last_media_id ):
+    cursor = conn.cursor()
+    cursor.execute( "select media_id from media where media_id > %s and media_id <= %s order by media_id",
+                    ( last_feeds_media_id or 0, last_media_id or 0 ) )
+    media = [ { 'media_id': row[ 0 ] } for row in cursor.fetchall() ]
     cursor.close()
-    conn.commit()    
+
+    return media
+
+def import_media_and_feeds( conn, mc, batch_size=None, threads=None, requests_per_second=None ):
+    """Stream media pages into the database and on into the feed fetching threads
+
+    Pages of media are fetched ahead in a background thread while the previous ones are written.
+    Each page is committed before its media are handed to fetch_feeds(), as feeds reference media.
+    Memory use is bounded by the prefetched pages, the feed requests in flight and one batch of each
+    table, whatever the size of the catalog.
+
+    The import continues after the media and feeds checkpoints, so an interrupted import can be
+    resumed by calling this again.
+    """
+    if requests_per_second is None:
+        requests_per_second = api_requests_per_second
+
+    last_media_id = get_checkpoint( conn, last_media_id_var )
+    last_feeds_media_id = get_checkpoint( conn, last_feeds_media_id_var )
+
+    # media pages and feed lists share the API rate limit
+    rate_limiter = RateLimiter( requests_per_second )
+
+    inserter = media_inserter( conn, batch_size )
+
+    def written_media():
+        # media committed by an earlier run whose feeds were not
+        for medium in _media_without_feeds( conn, last_feeds_media_id, last_media_id ):
+            yield medium
+
+        for media in prefetch( iter_media_pages( mc, rate_limiter, last_media_id or 0 ), media_pages_prefetched ):
+            for medium in media:
+                inserter.add( prepare_medium( medium ) )
+            inserter.flush()
+
+            print "Inserted " + str( inserter.rows_inserted ) + " media"
+
+            for medium in media:
+                yield medium
+
+    add_feeds_from_media_to_database( conn, mc, written_media(), batch_size, threads, rate_limiter=rate_limiter )
+
+    print "set dup_media_id for " + str( set_dup_media_ids( conn ) ) + " media"
 
 def main():
 
     parser = argparse.ArgumentParser(description='Import media and feeds listing from the production machine into the local database.')
 
     parser.add_argument( '--api-key', required=True )
+    parser.add_argument( '--batch-size', type=int, default=insert_batch_size, help='rows inserted and committed at a time' )
+    parser.add_argument( '--feed-threads', type=int, default=feed_fetch_threads, help='concurrent feed list requests' )
+    parser.add_argument( '--requests-per-second', type=float, default=api_requests_per_second,
+                         help='maximum rate of feed list requests' )
+    parser.add_argument( '--resume', action='store_true',
+                         help='continue an interrupted import from its last checkpoint instead of starting over' )
 
     args = parser.parse_args()
     api_key = args.api_key
+    batch_size = args.batch_size
 
-    if not yesno('This will erase all data in the current media cloud database. Are you sure you want to continue?'):
+    if not args.resume and not yesno('This will erase all data in the current media cloud database. Are you sure you want to continue?'):
         exit()
 
 
     mc = mediacloud.api.MediaCloud(api_key, all_fields=True)
 
     conn = mc_database.connect_to_database()
-    print "truncating tables"
 
-    truncate_tables( conn )
-    update_db_sequences(conn)
-    print "obtaining tag sets"
-    all_tag_sets = get_tag_sets( mc )
-
-    print "importing tag sets"
-    add_tag_sets_to_database( conn, all_tag_sets )
+    if args.resume:
+        print "resuming after tag set {}, medium {} and the feeds of medium {}".format(
+            get_checkpoint( conn, last_tag_sets_id_var ), get_checkpoint( conn, last_media_id_var ),
+            get_checkpoint( conn, last_feeds_media_id_var ) )
+    else:
+        print "truncating tables"
 
-    print "obtaining media"
-    all_media = get_media( mc )
+        truncate_tables( conn )
+        clear_checkpoints( conn )
+        update_db_sequences(conn)
 
-    print "importing media"
-    add_media_to_database( conn, all_media )
+    print "importing tag sets"
+    last_tag_sets_id = get_checkpoint( conn, last_tag_sets_id_var ) or 0
+    rate_limiter = RateLimiter( args.requests_per_second )
+    add_tag_sets_to_database( conn, prefetch( iter_tag_sets( mc, rate_limiter, last_tag_sets_id ), batch_size ), batch_size )
 
-    print "importing feeds from media"
-    add_feeds_from_media_to_database( conn, mc, all_media )
+    print "importing media and their feeds"
+    import_media_and_feeds( conn, mc, batch_size, args.feed_threads, args.requests_per_second )
 
     print "updating sequences"
     update_db_sequences(conn)
@@ -1,6 +1,17 @@
 #!/usr/bin/python
 
 import time
+import heapq
+import itertools
+import json
+import contextlib
+import cPickle
+import datetime
+import hashlib
+import math
+import os
+import random
+import threading
 
 import ipdb
 #import time
@@ -18,12 +29,91 @@ from nltk.stem.porter import PorterStemmer
 import multiprocessing
 from nltk.tokenize import RegexpTokenizer
 
+import mc_cache
+import mc_metrics
+import mc_solr
+
+try:
+    import psycopg2.extensions
+    import psycopg2.extras
+    import mc_database_pool
+except ImportError:
+    mc_database_pool = None
+
 from joblib import Parallel, delayed
 import multiprocessing
+import multiprocessing.pool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 in_memory_word_count_threshold = 0
 
+# number of documents requested per page when fetching with a Solr cursor
+cursor_fetch_rows = 10000
+
+# Solr requires a sort on the uniqueKey field for cursorMark deep paging
+cursor_sort = 'solr_id asc'
+
+# maximum number of terms kept in the term to stem cache
+stem_cache_max_size = 2000000
+
+# number of sentences joined into a single string by batch_count_terms()
+tokenize_batch_size = 5000
+
+# long lived pool shared by all word counts, see start_worker_pool()
+_worker_pool = None
+
+# budget for the per day term counts kept by day_term_count_cache, as the sum of their distinct terms
+day_cache_max_terms = 5000000
+
+# seconds after which cached per day term counts are recounted
+day_cache_ttl = 24 * 60 * 60
+
+# publish_date ranges spanning more days than this are counted in one piece
+max_day_buckets = 120
+
+# number of sentences counted by get_sampled_word_counts() when no sample size or time budget is given
+default_sample_size = 100000
+
+# documents requested per page when fetching a random sample
+sample_fetch_rows = 5000
+
+# rows per round trip of the server side cursor used by fetch_pages_postgres()
+postgres_fetch_rows = 10000
+
+# label of the database in mediawords.yml read by the 'postgres' backend, None for the first one
+postgres_db_label = None
+
+# number of disjoint sub-queries fetched concurrently by sharded_word_count(); 1 fetches with a single cursor
+fetch_shards = 4
+
+# per language stopword lists, in order of preference; the Media Cloud lists are used where they exist
+stopword_file_patterns = [
+    os.path.abspath( os.path.join( os.path.dirname( __file__ ), '..', 'lib', 'MediaWords', 'Languages', 'resources',
+                                   '{}_stoplist_short.txt' ) ),
+    os.path.abspath( os.path.join( os.path.dirname( __file__ ), '..', 'lib', 'MediaWords', 'Languages', 'resources',
+                                   '{}_stoplist.txt' ) ),
+    os.path.abspath( os.path.join( os.path.dirname( __file__ ), '..', 'solr', 'mediacloud', 'solr', 'collection1',
+                                   'conf', 'lang', 'stopwords_{}.txt' ) ),
+    ]
+
+# languages making up less of the matching sentences than this are ignored by detect_languages()
+min_language_fraction = 0.05
+
+phase_seconds = mc_metrics.histogram( 'word_count_phase_seconds',
+                                      'Seconds spent in each phase of counting words; count is summed over pool workers' )
+
+documents_fetched = mc_metrics.counter( 'word_count_documents_fetched_total', 'Sentences fetched from Solr for word counting' )
+
+bytes_fetched = mc_metrics.counter( 'word_count_fetched_bytes_total', 'Size of the Solr responses read by cursor fetches' )
+
+distinct_terms = mc_metrics.histogram( 'word_count_distinct_terms', 'Distinct terms counted per word count',
+                                       buckets=( 100, 1000, 10000, 100000, 1000000, 10000000 ) )
+
 def fetch_all( solr, fq, query, fields=None ) :
     documents = []
     num_matching_documents = solr.search( query, **{ 'fq': fq } ).hits
@@ -36,13 +126,15 @@ def fetch_all( solr, fq, query, fields=None ) :
     while (len( documents ) < num_matching_documents):
         sys.stderr.write( 'fetching {0} documents'.format( rows ) )
         sys.stderr.write( "\n" );
-        results = solr.search( query, **{
-                'fq': fq,
-                'start': start,
-                'rows': rows,
-                'fl' : fields,
-                })
+        with mc_metrics.timer( phase_seconds, phase='fetch' ):
+            results = solr.search( query, **{
+                    'fq': fq,
+                    'start': start,
+                    'rows': rows,
+                    'fl' : fields,
+                    })
         documents.extend( results.docs )
+        documents_fetched.inc( len( results.docs ) )
         start += rows
 
         assert len( documents ) <= num_matching_documents
@@ -50,6 +142,192 @@ def fetch_all( solr, fq, query, fields=None ) :
     assert len( documents ) == num_matching_documents
     return documents
 
+def fetch_all_cursor( solr, fq, query, fields=None, rows=cursor_fetch_rows ):
+    """Generator version of fetch_all() that pages through the results with Solr deep paging cursors
+
+    Only a single page of documents is held at a time so memory stays flat regardless of the number
+    of hits, and callers can start processing the first documents before the last page is downloaded.
+    """
+    for page in fetch_pages_cursor( solr, fq, query, fields, rows ):
+        for document in page:
+            yield document
+
+def fetch_pages_cursor( solr, fq, query, fields=None, rows=cursor_fetch_rows ):
+    """Like fetch_all_cursor() but yields each page of documents as a list
+
+    Falls back to start/rows paging if Solr does not support cursorMark, as before 4.7.
+    """
+    params = {
+        'q': query,
+        'fq': fq,
+        'rows': rows,
+        'sort': cursor_sort,
+        'wt': 'json',
+        }
+
+    if fields:
+        params[ 'fl' ] = fields
+
+    params = { k: v for k, v in params.items() if v is not None }
+
+    cursor_mark = '*'
+
+    sys.stderr.write( " starting cursor fetch for \n" + query + "\n" )
+    while True:
+        params[ 'cursorMark' ] = cursor_mark
+        with mc_metrics.timer( phase_seconds, phase='fetch' ):
+            response_text = solr._select( params )
+            response = json.loads( response_text )
+
+        page = response[ 'response' ][ 'docs' ]
+        bytes_fetched.inc( len( response_text ) )
+        documents_fetched.inc( len( page ) )
+
+        yield page
+
+        next_cursor_mark = response.get( 'nextCursorMark' )
+
+        # Solr before 4.7 ignores cursorMark and returns the first page sorted by cursor_sort
+        if next_cursor_mark is None:
+            sys.stderr.write( "Solr returned no nextCursorMark, falling back to start/rows paging\n" )
+            if len( page ) == rows:
+                del params[ 'cursorMark' ]
+                for page in _fetch_pages_by_offset( solr, params, rows ):
+                    yield page
+            break
+
+        # Solr returns the cursor it was given once the results are exhausted
+        if next_cursor_mark == cursor_mark:
+            break
+
+        cursor_mark = next_cursor_mark
+
+def _fetch_pages_by_offset( solr, params, start ):
+    """Yield the pages of params from start onwards with start/rows paging, for Solr without cursorMark"""
+    rows = params[ 'rows' ]
+    while True:
+        params[ 'start' ] = start
+        with mc_metrics.timer( phase_seconds, phase='fetch' ):
+            response_text = solr._select( params )
+            response = json.loads( response_text )
+
+        page = response[ 'response' ][ 'docs' ]
+        bytes_fetched.inc( len( response_text ) )
+        documents_fetched.inc( len( page ) )
+
+        if page:
+            yield page
+
+        start += len( page )
+        if len( page ) < rows or start >= response[ 'response' ][ 'numFound' ]:
+            break
+
+_range_fq_pattern = re.compile( r'^\s*publish_date:([\[{])(\S+) TO (\S+)([\]}])\s*$' )
+
+_field_values_fq_pattern = re.compile( r'^\s*(media_id|language):(?:(\w+)|\(\s*(\w+(?:\s+OR\s+\w+)*)\s*\))\s*$' )
+
+def sentence_filter_sql( fq, query ):
+    """Translate query and fq into a WHERE clause on story_sentences
+
+    Only match all queries with publish_date range, media_id and language filter queries can be
+    answered from Postgres. Returns a ( sql, params ) pair, or None for anything else.
+    """
+    if query not in ( None, '', '*:*' ):
+        return None
+
+    if fq is None:
+        fq = []
+    elif isinstance( fq, basestring ):
+        fq = [ fq ]
+
+    clauses = [ 'true' ]
+    params = []
+    for filter_query in fq:
+        if filter_query in ( None, 'None', '*:*' ):
+            continue
+
+        match = _range_fq_pattern.match( filter_query )
+        if match is not None:
+            start_inclusive, start, end, end_inclusive = match.groups()
+            for date_str, operator in ( ( start, '>=' if start_inclusive == '[' else '>' ),
+                                        ( end, '<=' if end_inclusive == ']' else '<' ) ):
+                if date_str == '*':
+                    continue
+
+                date = _parse_solr_date( date_str )
+                if date is None:
+                    return None
+
+                clauses.append( 'publish_date {} %s'.format( operator ) )
+                params.append( date )
+
+            continue
+
+        match = _field_values_fq_pattern.match( filter_query )
+        if match is not None:
+            field, value, values = match.groups()
+            values = [ value ] if value is not None else re.split( r'\s+OR\s+', values )
+            if field == 'media_id':
+                if not all( v.isdigit() for v in values ):
+                    return None
+                values = [ int( v ) for v in values ]
+
+            clauses.append( '{} in %s'.format( field ) )
+            params.append( tuple( values ) )
+
+            continue
+
+        return None
+
+    return ' and '.join( clauses ), params
+
+def fetch_pages_postgres( fq, query, rows=None, db_label=None ):
+    """Like fetch_pages_cursor() but reads the sentences straight from story_sentences
+
+    A named cursor keeps the result set on the server, so only rows sentences are held at a time.
+    Raises an Exception if fq and query cannot be translated by sentence_filter_sql().
+    """
+    if mc_database_pool is None:
+        raise Exception( "psycopg2 is required for the postgres word count backend" )
+
+    where = sentence_filter_sql( fq, query )
+    if where is None:
+        raise Exception( "query {} with fq {} cannot be answered from postgres".format( query, fq ) )
+
+    if rows is None:
+        rows = postgres_fetch_rows
+
+    with mc_database_pool.connection( db_label or postgres_db_label ) as conn:
+        cursor = conn.cursor( 'word_count_sentences', cursor_factory=psycopg2.extras.DictCursor )
+        cursor.itersize = rows
+        psycopg2.extensions.register_type( psycopg2.extensions.UNICODE, cursor )
+
+        sys.stderr.write( " starting postgres fetch for \n" + str( fq ) + "\n" )
+        with mc_metrics.timer( phase_seconds, phase='fetch' ):
+            cursor.execute( 'select sentence from story_sentences where ' + where[ 0 ], where[ 1 ] )
+
+        while True:
+            with mc_metrics.timer( phase_seconds, phase='fetch' ):
+                page = cursor.fetchmany( rows )
+
+            if not page:
+                break
+
+            documents_fetched.inc( len( page ) )
+
+            yield page
+
+        cursor.close()
+
+def batches( iterable, batch_size ):
+    iterator = iter( iterable )
+    while True:
+        batch = list( itertools.islice( iterator, batch_size ) )
+        if not batch:
+            break
+
+        yield batch
+
 
 #tokenizer = RegexpTokenizer(r'\w+')
 
@@ -59,7 +337,7 @@ def tokenize( str ):
 
 def split_into_chunks( list, partitions ):
     print "starting split_into_chunks"
-    partition_size = len( list ) / partitions
+    partition_size = max( len( list ) / partitions, 1 )
     chunks = [ list[start:start+partition_size] for start in xrange( 0, len(list), partition_size ) ]
 
     print "returning from split_into_chunks"
@@ -77,74 +355,445 @@ def get_frequency_counts( token_lists ):
         freq.update( token_list )
 
     return freq
-    
-    
-def non_stemmed_word_count( sentences ):
+
+_token_pattern = re.compile( r'\w+' )
+
+_non_token_pattern = re.compile( r'\W' )
+
+def lowercase_sentences( pages ):
+    """Generator of the lowercased sentences of pages of Solr documents or story_sentences rows"""
+    for page in pages:
+        with mc_metrics.timer( phase_seconds, phase='lowercase' ):
+            sentences = [ document[ 'sentence' ].lower() for document in page ]
+
+        for sentence in sentences:
+            yield sentence
+
+class SentenceDeduplicator( object ):
+    """Collapses identical sentences before they are tokenized
+
+    Sentences are keyed on the first 8 bytes of their md5, like the half_md5() index on story_sentences.
+    Only the first occurrence of each sentence is passed on. With weighted=True repeated sentences are
+    remembered so that add_repeat_counts() can add their terms once per repeat, which gives the same
+    counts as not deduplicating while tokenizing each distinct sentence once.
+    """
+
+    def __init__( self, weighted=False ):
+        self.weighted = weighted
+        self.duplicates = 0
+        self._seen = set()
+        self._repeats = {}
+
+    def unique_sentences( self, sentences ):
+        for sentence in sentences:
+            key = hashlib.md5( sentence.encode( 'utf-8' ) if isinstance( sentence, unicode ) else sentence ).digest()[ :8 ]
+
+            if key not in self._seen:
+                self._seen.add( key )
+                yield sentence
+                continue
+
+            self.duplicates += 1
+
+            if self.weighted:
+                repeat = self._repeats.get( key )
+                if repeat is None:
+                    self._repeats[ key ] = [ sentence, 1 ]
+                else:
+                    repeat[ 1 ] += 1
+
+    def add_repeat_counts( self, term_counts, token_filter=None ):
+        for sentence, repeats in self._repeats.itervalues():
+            counts = count_terms( [ sentence ], token_filter )
+            term_counts.update( { term: count * repeats for term, count in counts.iteritems() } )
+
+        return term_counts
+
+def _count_empty_tokens( sentences ):
+    """Number of empty strings tokenize() would return for sentences
+
+    re.split() yields an empty string for an empty sentence and for a delimiter at either end.
+    """
+    empty_tokens = 0
+    for sentence in sentences:
+        if not sentence:
+            empty_tokens += 1
+        else:
+            if _non_token_pattern.match( sentence ):
+                empty_tokens += 1
+            if _non_token_pattern.match( sentence, len( sentence ) - 1 ):
+                empty_tokens += 1
+
+    return empty_tokens
+
+def _count_hashed_tokens( tokens ):
+    # a 64 bit hash collision between two distinct terms would merge their counts
+    ids = numpy.fromiter( itertools.imap( hash, tokens ), dtype=numpy.int64, count=len( tokens ) )
+    unique_ids, first_indexes, counts = numpy.unique( ids, return_index=True, return_counts=True )
+
+    return dict( itertools.izip( ( tokens[ i ] for i in first_indexes.tolist() ), counts.tolist() ) )
+
+def batch_count_terms( sentences, batch_size=tokenize_batch_size, hashed=False ):
+    """Tokenize and count sentences batch_size at a time
+
+    Each batch is joined into one string and tokenized with a single findall(), so no token list is
+    allocated per sentence. The result is identical to counting tokenize() of every sentence. With
+    hashed=True tokens are counted as integer hash ids with numpy.unique(), which needs numpy.
+    """
+    if hashed and numpy is None:
+        raise Exception( "hashed token counting requires numpy" )
+
+    counts = collections.defaultdict( int )
+
+    for batch in batches( sentences, batch_size ):
+        separator = u' ' if isinstance( batch[ 0 ], unicode ) else ' '
+        tokens = _token_pattern.findall( separator.join( batch ) )
+
+        if hashed:
+            for token, count in _count_hashed_tokens( tokens ).iteritems():
+                counts[ token ] += count
+        else:
+            for token in tokens:
+                counts[ token ] += 1
+
+        empty_tokens = _count_empty_tokens( batch )
+        if empty_tokens:
+            counts[ '' ] += empty_tokens
+
+    return collections.Counter( counts )
+
+_stopwords = {}
+
+def load_stopwords( language ):
+    """The set of stopwords for a two letter language code, empty if there is no list for it"""
+    if language not in _stopwords:
+        stopwords = set()
+
+        file_paths = [ pattern.format( language ) for pattern in stopword_file_patterns ]
+        file_paths = [ file_path for file_path in file_paths if os.path.isfile( file_path ) ]
+
+        if file_paths:
+            with open( file_paths[ 0 ], 'rb' ) as f:
+                for line in f:
+                    # both the plain and the snowball formats allow trailing comments
+                    line = line.decode( 'utf-8' ).split( '|' )[ 0 ].strip()
+                    if line and not line.startswith( '#' ):
+                        stopwords.add( line.split()[ 0 ].lower() )
+
+        _stopwords[ language ] = frozenset( stopwords )
+
+    return _stopwords[ language ]
+
+class TokenFilter( object ):
+    """Drops stopwords, tokens shorter than min_length and, optionally, purely numeric tokens
+
+    Applied inside the pool workers to the terms of each chunk before they are merged, so merging and
+    stemming only see the filtered vocabulary.
+    """
+
+    def __init__( self, languages=(), min_length=1, drop_numeric=False ):
+        self.languages = tuple( sorted( languages ) )
+        self.min_length = min_length
+        self.drop_numeric = drop_numeric
+        self.stopwords = frozenset().union( *[ load_stopwords( language ) for language in self.languages ] )
+
+    def cache_key( self ):
+        return ( self.languages, self.min_length, self.drop_numeric )
+
+    def keep( self, term ):
+        return len( term ) >= self.min_length and \
+            term not in self.stopwords and \
+            not ( self.drop_numeric and term.isdigit() )
+
+    def filter_counts( self, term_counts ):
+        return collections.Counter( { term: count for term, count in term_counts.iteritems() if self.keep( term ) } )
+
+def detect_languages( solr, fq, query, min_fraction=None ):
+    """Languages of at least min_fraction of the sentences matching query, from a facet on the language field"""
+    if min_fraction is None:
+        min_fraction = min_language_fraction
+
+    results = solr.search( query, **{
+            'fq': fq,
+            'rows': 0,
+            'facet': 'true',
+            'facet.field': 'language',
+            'facet.mincount': 1,
+            })
+
+    facets = results.facets[ 'facet_fields' ][ 'language' ]
+    language_counts = dict( zip( facets[0::2], facets[1::2] ) )
+
+    total = max( results.hits, 1 )
+
+    return sorted( language for language, count in language_counts.iteritems() if float( count ) / total >= min_fraction )
+
+def language_fq( languages ):
+    """Filter query restricting sentences to languages"""
+    return 'language:({})'.format( ' OR '.join( languages ) )
+
+def count_terms( sentences, token_filter=None ):
+    """Tokenize and count a chunk of sentences in a single pass
+
+    Run inside the pool workers so that only the resulting Counter, rather than every token list,
+    is pickled back to the parent.
+    """
+    counts = batch_count_terms( sentences )
+
+    if token_filter is not None:
+        counts = token_filter.filter_counts( counts )
+
+    return counts
+
+def _timed_count_terms( sentences_and_filter ):
+    sentences, token_filter = sentences_and_filter
+
     start_time = time.time()
-    non_stemmed_word_count_start_time = start_time
-    print "starting  non_stemmed_word_count "
-    print time.asctime()
+    counts = count_terms( sentences, token_filter )
 
-    print 'tokenizing '
+    return counts, time.time() - start_time
 
-   # token_lists = Parallel(n_jobs=8, verbose=5, pre_dispatch='3*n_jobs')(delayed ( tokenize)( sentence) for sentence in sentences )
+def _merge_timed_counts( timed_counts ):
+    for counts, seconds in timed_counts:
+        phase_seconds.observe( seconds, phase='count' )
 
-    pool = multiprocessing.Pool() 
+    with mc_metrics.timer( phase_seconds, phase='merge' ):
+        return merge_counters( [ counts for counts, seconds in timed_counts ] )
 
-    token_lists = pool.map( tokenize, sentences )
+def merge_counters( counters ):
+    """Merge partial Counters into the first one
 
-    pool.close()
-    pool.join()
+    The partials have already been pickled back from the workers, so they are merged here in the
+    parent; sending them through the pool again would cost more in pickling than the merge itself.
+    """
+    counters = list( counters )
+    if not counters:
+        return collections.Counter()
 
-    end_time = time.time()
-    print 'done tokenizing'
-    print "time {}".format( str(end_time - start_time) )
+    merged = counters[ 0 ]
+    for counter in counters[ 1: ]:
+        merged.update( counter )
 
-    print 'chunking '
+    return merged
+
+def start_worker_pool( processes=None, maxtasksperchild=None ):
+    """Create the process wide worker pool used by every subsequent word count
+
+    Workers are replaced after maxtasksperchild tasks to contain memory growth. Without a shared pool
+    each word count creates and tears down its own.
+    """
+    global _worker_pool
+
+    if _worker_pool is None:
+        _worker_pool = multiprocessing.Pool( processes=processes, maxtasksperchild=maxtasksperchild )
+
+    return _worker_pool
+
+def stop_worker_pool():
+    global _worker_pool
+
+    if _worker_pool is not None:
+        _worker_pool.close()
+        _worker_pool.join()
+        _worker_pool = None
+
+@contextlib.contextmanager
+def _word_count_pool():
+    if _worker_pool is not None:
+        yield _worker_pool
+        return
+
+    pool = multiprocessing.Pool()
+    try:
+        yield pool
+    finally:
+        pool.close()
+        pool.join()
+
+def non_stemmed_word_count( sentences, num_chunks=20, token_filter=None ):
     start_time = time.time()
+    print "starting  non_stemmed_word_count "
+    print time.asctime()
 
-    chunks = split_into_chunks( token_lists, 20 )
+    print 'chunking '
+
+    chunks = split_into_chunks( sentences, num_chunks )
 
     end_time = time.time()
 
     print 'done chunking '
     print "time {}".format( str(end_time - start_time) )
 
+    print 'tokenizing and getting freq counts'
+
+    with _word_count_pool() as pool:
+        freq_counts = pool.map( _timed_count_terms, [ ( chunk, token_filter ) for chunk in chunks ] )
+
+        end_time = time.time()
+        print "time {}".format( str(end_time - start_time) )
+        print 'done tokenizing and getting freq counts'
 
-    print 'getting freq counts'
+        print "merging freq_counts "
+        merge_start_time = end_time
 
+        freq = _merge_timed_counts( freq_counts )
+
+    end_time = time.time()
+
+    print "done merging freq_counts "
+    print "time {}".format( str(end_time - merge_start_time) )
+
+    print "Returning"
+    print time.asctime()
+    print "total subroution time: {} ".format( end_time - start_time )
+    return freq
+
+def streaming_non_stemmed_word_count( sentences, batch_size=cursor_fetch_rows, num_chunks=multiprocessing.cpu_count(),
+                                      token_filter=None ):
+    """Count terms in an iterable of sentences without materializing it
+
+    Each batch of sentences is split into chunks that are tokenized and counted in the pool while the
+    next batch is being fetched, so at most two batches are in memory at once.
+    """
     start_time = time.time()
-    pool =  multiprocessing.Pool() 
+    print "starting streaming_non_stemmed_word_count "
+    print time.asctime()
+
+    freq = collections.Counter()
+
+    sentences_processed = 0
+    with _word_count_pool() as pool:
+        pending = None
+        for batch in batches( sentences, batch_size ):
+            chunks = split_into_chunks( batch, num_chunks )
+            result = pool.map_async( _timed_count_terms, [ ( chunk, token_filter ) for chunk in chunks ] )
 
-    freq_counts = pool.map( get_frequency_counts, chunks )
+            if pending is not None:
+                freq.update( _merge_timed_counts( pending.get() ) )
 
-    pool.close()
-    pool.join()
+            pending = result
+            sentences_processed += len( batch )
 
-    pool = None
+        if pending is not None:
+            freq.update( _merge_timed_counts( pending.get() ) )
 
     end_time = time.time()
-    print "time {}".format( str(end_time - start_time) )
-    print 'done getting freq counts'
+    print "counted {} sentences".format( sentences_processed )
+    print "total subroution time: {} ".format( end_time - start_time )
 
-    print "summing freq_counts "
-    start_time = end_time
+    return freq
+
+def shard_fqs( fq, num_shards ):
+    """Split fq into up to num_shards lists of filter queries matching disjoint parts of its results
+
+    A single publish_date range with concrete dates, inclusive or exclusive at either end, is cut into
+    equal time slices. An empty or zero width range is not split. Otherwise the documents are
+    partitioned on stories_id modulo num_shards.
+    """
+    if fq is None:
+        fq = []
+    elif isinstance( fq, basestring ):
+        fq = [ fq ]
+
+    date_ranges = [ _range_fq_pattern.match( filter_query ) for filter_query in fq ]
+    date_ranges = [ match for match in date_ranges if match is not None ]
+
+    if len( date_ranges ) == 1:
+        start_bracket, start_date, end_date, end_bracket = date_ranges[ 0 ].groups()
+        start_date = _parse_solr_date( start_date )
+        end_date = _parse_solr_date( end_date )
+
+        if start_date is not None and end_date is not None:
+            if start_date >= end_date:
+                return [ fq ]
+
+            other_fq = [ filter_query for filter_query in fq if _range_fq_pattern.match( filter_query ) is None ]
 
+            seconds = int( ( end_date - start_date ).total_seconds() )
+            num_shards = max( min( num_shards, seconds ), 1 )
+            boundaries = [ start_date + datetime.timedelta( seconds=( seconds * i ) / num_shards ) for i in xrange( num_shards ) ]
+            boundaries.append( end_date )
+
+            ret = []
+            for i in xrange( num_shards ):
+                # the first and last slices keep the original brackets, the slices in between are half open
+                ret.append( other_fq + [ 'publish_date:{}{} TO {}{}'.format( start_bracket if i == 0 else '[',
+                                                                            _format_solr_date( boundaries[ i ] ),
+                                                                            _format_solr_date( boundaries[ i + 1 ] ),
+                                                                            end_bracket if i == num_shards - 1 else '}' ) ] )
+
+            return ret
+
+    return [ fq + [ '{{!frange l={0} u={0}}}mod(stories_id,{1})'.format( i, num_shards ) ] for i in xrange( num_shards ) ]
+
+def _count_shard( solr, fq, query, token_filter, pool ):
+    """Fetch one shard with a cursor, counting each page in pool while the next one is fetched"""
     freq = collections.Counter()
 
-    for freq_count in freq_counts:
-        freq += freq_count
+    pending = None
+    for page in fetch_pages_cursor( solr, fq, query, 'sentence' ):
+        with mc_metrics.timer( phase_seconds, phase='lowercase' ):
+            sentences = [ document[ 'sentence' ].lower() for document in page ]
 
-    end_time = time.time()
+        result = pool.apply_async( _timed_count_terms, ( ( sentences, token_filter ), ) )
 
-    print "done summing freq_counts "
-    print "time {}".format( str(end_time - start_time) )
+        if pending is not None:
+            freq.update( _merge_timed_counts( [ pending.get() ] ) )
+
+        pending = result
+
+    if pending is not None:
+        freq.update( _merge_timed_counts( [ pending.get() ] ) )
 
-    print "Returning"
-    print time.asctime()
-    print "total subroution time: {} ".format( end_time - non_stemmed_word_count_start_time )
     return freq
 
+def sharded_word_count( solr, fq, query, num_shards=None, token_filter=None ):
+    """Count terms of the sentences matching query and fq, fetching shard_fqs() concurrently
+
+    Each shard is read by its own thread, which hands every page straight to the counting workers so
+    that network and CPU time overlap. solr should keep a connection per shard alive, as the shared
+    client behind mc_solr.pooled_solr_connection() does.
+    """
+    if num_shards is None:
+        num_shards = fetch_shards
+
+    start_time = time.time()
+    print "starting sharded_word_count with {} shards".format( num_shards )
+
+    shards = shard_fqs( fq, num_shards )
+
+    freq = collections.Counter()
+    with _word_count_pool() as pool:
+        threads = multiprocessing.pool.ThreadPool( len( shards ) )
+        try:
+            shard_counts = threads.map( lambda shard_fq: _count_shard( solr, shard_fq, query, token_filter, pool ), shards )
+        finally:
+            threads.close()
+            threads.join()
+
+    with mc_metrics.timer( phase_seconds, phase='merge' ):
+        for counts in shard_counts:
+            freq.update( counts )
+
+    print "total subroution time: {} ".format( time.time() - start_time )
+
+    return freq
+
+def fetch_all_sharded( solr, fq, query, fields=None, num_shards=None ):
+    """Like fetch_all() but fetches the shard_fqs() of the query concurrently"""
+    if num_shards is None:
+        num_shards = fetch_shards
+
+    def fetch_shard( shard_fq ):
+        return list( fetch_all_cursor( solr, shard_fq, query, fields ) )
+
+    threads = multiprocessing.pool.ThreadPool( num_shards )
+    try:
+        return list( itertools.chain.from_iterable( threads.map( fetch_shard, shard_fqs( fq, num_shards ) ) ) )
+    finally:
+        threads.close()
+        threads.join()
+
 def in_memory_word_count( sentences ):
     freq = collections.Counter()
     for sentence in sentences:
@@ -152,18 +801,9 @@ def in_memory_word_count( sentences ):
     
     return freq
 
-def solr_connection() :
-    return pysolr.Solr('http://localhost:8983/solr/')
-
-def get_word_counts( solr, fq, query, num_words, field='sentence' ) :
-    print query
-
-    print str(time.asctime())
-
+def _fetch_and_count_in_memory( solr, fq, query, token_filter=None, deduplicator=None ):
     start_time = time.time()
 
-    function_start_time = start_time
-    
     results = fetch_all( solr, fq, query, 'sentence' )
     print "got " + query
     print len( results )
@@ -175,7 +815,11 @@ def get_word_counts( solr, fq, query, num_words, field='sentence' ) :
     start_time = end_time
 
     print 'converting to utf8 and lowercasing';
-    sentences = [ result['sentence'].lower() for result in results ]
+    with mc_metrics.timer( phase_seconds, phase='lowercase' ):
+        sentences = [ result['sentence'].lower() for result in results ]
+
+    if deduplicator is not None:
+        sentences = list( deduplicator.unique_sentences( sentences ) )
 
     results = None
 
@@ -184,83 +828,401 @@ def get_word_counts( solr, fq, query, num_words, field='sentence' ) :
 
     start_time = end_time
 
-
     print 'calculating non_stemmed_wordcounts'
-    term_counts = non_stemmed_word_count( sentences )
-
-    if '' in term_counts:
-        del term_counts['']
+    term_counts = non_stemmed_word_count( sentences, token_filter=token_filter )
 
     print "Returned from non_stemmed_word_count"
     print time.asctime()
     end_time = time.time()
     print "time {}".format( str(end_time - start_time) )
 
-    start_time = end_time
-    print "freeing sentences "
-    sentences = None
-    
-    end_time = time.time()
-    print "time {}".format( str(end_time - start_time) )
+    return term_counts
 
+class StemCache( object ):
+    """Bounded, thread safe term to stem cache with least recently used eviction"""
 
-    start_time = end_time
+    def __init__( self, max_size=stem_cache_max_size ):
+        self.max_size = max_size
+        self._stems = collections.OrderedDict()
+        self._stemmer = PorterStemmer()
+        self._lock = threading.Lock()
 
-    print 'stemming and counting'
+    def __len__( self ):
+        return len( self._stems )
 
-    stem_counts = collections.Counter()
+    def stem_terms( self, terms ):
+        """Return the list of stems for terms, stemming and caching the ones not seen before"""
+        stems = []
+        with self._lock:
+            for term in terms:
+                stem = self._stems.pop( term, None )
+                if stem is None:
+                    stem = self._stemmer.stem_word( term )
 
-    st = PorterStemmer()
-    for term in term_counts.keys():
-        #ipdb.set_trace()
-        stem = st.stem_word( term )
-        stem_counts[ stem ] += term_counts[ term ]
+                # (re)inserting moves the term to the most recently used end
+                self._stems[ term ] = stem
+                stems.append( stem )
 
+            while len( self._stems ) > self.max_size:
+                self._stems.popitem( last=False )
 
-    end_time = time.time()
-    print "done stemming and counting "
-    print "time {}".format( str(end_time - start_time) )
+        return stems
 
-    start_time = end_time
+    def load( self, file_path ):
+        """Load cached stems saved by save(); a missing file leaves the cache empty"""
+        if not os.path.isfile( file_path ):
+            return
 
-    print ' calcuating stem to term map '
-    stem_to_terms = {}
-    for term in term_counts.keys():
-        stem = st.stem_word( term )
-        if stem not in stem_to_terms:
-            stem_to_terms[ stem ] = []
+        with open( file_path, 'rb' ) as f:
+            stems = cPickle.load( f )
 
-        stem_to_terms[stem].append( term )
+        with self._lock:
+            self._stems = stems
+            while len( self._stems ) > self.max_size:
+                self._stems.popitem( last=False )
 
-    print "done calcuating stem to term map "
-    print "time {}".format( str(end_time - start_time) )
+    def save( self, file_path ):
+        with self._lock:
+            stems = collections.OrderedDict( self._stems )
+
+        temp_file_path = file_path + '.tmp'
+        with open( temp_file_path, 'wb' ) as f:
+            cPickle.dump( stems, f, cPickle.HIGHEST_PROTOCOL )
+
+        os.rename( temp_file_path, file_path )
+
+# process wide cache shared by all word counts
+stem_cache = StemCache()
+
+def stem_term_counts( term_counts ):
+    """Stem term_counts in a single pass
+
+    Returns a Counter of stem counts and a dict mapping each stem to its most frequent term.
+    """
+    distinct_terms.observe( len( term_counts ) )
 
+    with mc_metrics.timer( phase_seconds, phase='stem' ):
+        stem_counts = collections.Counter()
+        best_terms = {}
+        best_term_counts = {}
 
-    counts = stem_counts.most_common( num_words )
+        terms = term_counts.keys()
+        stems = stem_cache.stem_terms( terms )
 
+        for term, stem in itertools.izip( terms, stems ):
+            count = term_counts[ term ]
+            stem_counts[ stem ] += count
+
+            if count > best_term_counts.get( stem, 0 ):
+                best_terms[ stem ] = term
+                best_term_counts[ stem ] = count
+
+    return stem_counts, best_terms
+
+def top_words( stem_counts, best_terms, num_words ):
     ret = [ ]
-    for stem, count in counts:
-        if len( stem_to_terms[ stem ] ) < 2:
-            term = stem_to_terms[ stem][0]
+    with mc_metrics.timer( phase_seconds, phase='top_k' ):
+        for stem, count in stem_counts.most_common( num_words ):
+            ret.append( 
+                { 'stem': stem, 
+                  'term': best_terms[ stem ],
+                  'count': count
+                  } )
+
+    return ret
+
+def solr_connection() :
+    return mc_solr.pooled_solr_connection( 'http://localhost:8983/solr/' )
+
+_publish_date_range_fq_pattern = re.compile( r'^\s*publish_date:\[(\S+) TO (\S+)\]\s*$' )
+
+_solr_date_pattern = re.compile( r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.0+)?Z(?:\+(\d+)DAYS?)?$' )
+
+def _parse_solr_date( date_str ):
+    """Parse an ISO Solr date with optional +NDAYS date math, or return None for anything else"""
+    match = _solr_date_pattern.match( date_str )
+    if match is None:
+        return None
+
+    date = datetime.datetime.strptime( match.group( 1 ), '%Y-%m-%dT%H:%M:%S' )
+    if match.group( 2 ):
+        date += datetime.timedelta( days=int( match.group( 2 ) ) )
+
+    return date
+
+def _format_solr_date( date ):
+    return date.strftime( '%Y-%m-%dT%H:%M:%SZ' )
+
+def split_publish_date_fq( fq ):
+    """Split the publish_date:[X TO Y] filter query out of fq into per day ranges
+
+    Returns the list of remaining filter queries and a list of ( fq, end date ) pairs, one per day,
+    that together cover exactly the same range as the original. Returns None if fq does not contain a
+    single publish_date range with concrete dates or if the range spans more than max_day_buckets days.
+    """
+    if fq is None:
+        fq = []
+    elif isinstance( fq, basestring ):
+        fq = [ fq ]
+
+    other_fq = []
+    date_range = None
+    for filter_query in fq:
+        match = _publish_date_range_fq_pattern.match( filter_query )
+        if match is None:
+            other_fq.append( filter_query )
+        elif date_range is None:
+            date_range = match.groups()
         else:
-            best_count = 0
-            for possible_best in stem_to_terms[ stem ] :
-                if term_counts[ possible_best ] > best_count:
-                    term = possible_best
-                    best_count = term_counts[ possible_best ]
+            return None
+
+    if date_range is None:
+        return None
 
-        ret.append( 
-            { 'stem': stem, 
-              'term': term,
-              'count': count
-              } )
+    start_date = _parse_solr_date( date_range[ 0 ] )
+    end_date = _parse_solr_date( date_range[ 1 ] )
+    if start_date is None or end_date is None or start_date > end_date:
+        return None
 
+    day_fqs = []
+    day_start = start_date
+    while True:
+        next_day = datetime.datetime.combine( day_start.date(), datetime.time() ) + datetime.timedelta( days=1 )
+
+        # the original range is inclusive of its end, so the last bucket is too
+        if next_day > end_date:
+            day_fqs.append( ( 'publish_date:[{} TO {}]'.format( _format_solr_date( day_start ), _format_solr_date( end_date ) ),
+                              end_date ) )
+            break
+
+        day_fqs.append( ( 'publish_date:[{} TO {}}}'.format( _format_solr_date( day_start ), _format_solr_date( next_day ) ),
+                          next_day ) )
+        day_start = next_day
+
+        if len( day_fqs ) > max_day_buckets:
+            return None
+
+    return other_fq, day_fqs
+
+# process wide cache of the term counts of a single day of a query, shared by all word counts; a single day can
+# have hundreds of thousands of distinct terms, so it is bounded by their total number
+day_term_count_cache = mc_cache.LruCache( day_cache_max_terms, day_cache_ttl, unit='terms' )
+
+def _count_terms_for_query( solr, fq, query, streaming, token_filter=None, dedup=None, backend='solr', num_shards=None ):
+    deduplicator = None
+    if dedup is not None:
+        deduplicator = SentenceDeduplicator( weighted=( dedup == 'weighted' ) )
+
+    # postgres results are always streamed
+    if backend == 'postgres':
+        sentences = lowercase_sentences( fetch_pages_postgres( fq, query ) )
+        if deduplicator is not None:
+            sentences = deduplicator.unique_sentences( sentences )
+
+        print 'calculating streaming non_stemmed_wordcounts from postgres'
+        term_counts = streaming_non_stemmed_word_count( sentences, token_filter=token_filter )
+    elif streaming and deduplicator is None and ( num_shards or fetch_shards ) > 1:
+        term_counts = sharded_word_count( solr, fq, query, num_shards, token_filter )
+    elif streaming:
+        sentences = lowercase_sentences( fetch_pages_cursor( solr, fq, query, 'sentence' ) )
+        if deduplicator is not None:
+            sentences = deduplicator.unique_sentences( sentences )
+
+        print 'calculating streaming non_stemmed_wordcounts'
+        term_counts = streaming_non_stemmed_word_count( sentences, token_filter=token_filter )
+    else:
+        term_counts = _fetch_and_count_in_memory( solr, fq, query, token_filter, deduplicator )
+
+    if deduplicator is not None:
+        print "skipped tokenizing {} duplicate sentences".format( deduplicator.duplicates )
+        deduplicator.add_repeat_counts( term_counts, token_filter )
+
+    return term_counts
+
+def count_terms_by_day( solr, fq, query, streaming=True, token_filter=None, dedup=None, backend='solr', num_shards=None ):
+    """Count terms with the publish_date range in fq split into days, reusing cached days
+
+    Days that end in the future are still changing and are always recounted. Returns None if fq
+    cannot be split by day.
+    """
+    split_fq = split_publish_date_fq( fq )
+    if split_fq is None:
+        return None
+
+    other_fq, day_fqs = split_fq
+
+    now = datetime.datetime.utcnow()
+
+    term_counts = collections.Counter()
+    days_counted = 0
+    for day_fq, day_end in day_fqs:
+        key = ( query, tuple( sorted( other_fq ) ), day_fq, token_filter.cache_key() if token_filter else None, dedup,
+                backend )
+
+        day_term_counts = day_term_count_cache.get( key )
+        if day_term_counts is None:
+            day_term_counts = _count_terms_for_query( solr, other_fq + [ day_fq ], query, streaming, token_filter, dedup,
+                                                      backend, num_shards )
+            days_counted += 1
+
+            if day_end <= now:
+                day_term_count_cache.put( key, day_term_counts )
+
+        with mc_metrics.timer( phase_seconds, phase='merge' ):
+            term_counts.update( day_term_counts )
+
+    print "counted {} of {} days, the rest were cached".format( days_counted, len( day_fqs ) )
+
+    return term_counts
+
+def get_word_counts( solr, fq, query, num_words, field='sentence', streaming=True, split_by_day=True, token_filter=None,
+                     dedup=None, backend='solr', num_shards=None ) :
+    """Top num_words stems of the sentences matching query and fq
+
+    dedup is None to count every sentence, 'unique' to count each distinct sentence once or 'weighted'
+    to tokenize each distinct sentence once but count it as often as it occurs.
+
+    backend is 'solr' or 'postgres' to read the sentences from story_sentences instead. Queries that
+    sentence_filter_sql() cannot translate are always read from Solr.
+
+    Streamed Solr fetches without dedup are split into num_shards concurrent sub-queries, fetch_shards
+    by default.
+    """
+    print query
+
+    print str(time.asctime())
+
+    start_time = time.time()
+
+    function_start_time = start_time
+
+    if backend == 'postgres' and sentence_filter_sql( fq, query ) is None:
+        print "query cannot be answered from postgres, using solr"
+        backend = 'solr'
+
+    # unique counts cannot be merged from days as the same sentence may occur on several days
+    if dedup == 'unique':
+        split_by_day = False
+
+    term_counts = None
+    if split_by_day:
+        term_counts = count_terms_by_day( solr, fq, query, streaming, token_filter, dedup, backend, num_shards )
+
+    if term_counts is None:
+        term_counts = _count_terms_for_query( solr, fq, query, streaming, token_filter, dedup, backend, num_shards )
+
+    if '' in term_counts:
+        del term_counts['']
+
+    end_time = time.time()
+    print "time {}".format( str(end_time - start_time) )
+
+    start_time = end_time
+
+    print 'stemming and counting'
+
+    stem_counts, best_terms = stem_term_counts( term_counts )
+
+    end_time = time.time()
+    print "done stemming and counting "
+    print "time {}".format( str(end_time - start_time) )
+
+    ret = top_words( stem_counts, best_terms, num_words )
 
     end_time  = time.time()
     print "total time {}".format( str(end_time - function_start_time) )
 
+    phase_seconds.observe( end_time - function_start_time, phase='total' )
+
     return ret
 
+def fetch_sample( solr, fq, query, sample_size, fields=None, rows=sample_fetch_rows, deadline=None ):
+    """Generator yielding a uniform random sample of up to sample_size matching documents
+
+    Documents are sorted on a freshly seeded random_* field and read from the top, so every matching
+    document is equally likely to be included. If deadline (a time.time() value) is given no further
+    pages are requested once it has passed.
+    """
+    sort = 'random_{} asc'.format( random.randint( 0, 2 ** 31 ) )
+
+    start = 0
+    while start < sample_size:
+        if deadline is not None and time.time() > deadline:
+            sys.stderr.write( "sample fetch time budget exhausted after {} documents\n".format( start ) )
+            break
+
+        page_rows = min( rows, sample_size - start )
+        with mc_metrics.timer( phase_seconds, phase='fetch' ):
+            results = solr.search( query, **{
+                    'fq': fq,
+                    'start': start,
+                    'rows': page_rows,
+                    'fl': fields,
+                    'sort': sort,
+                    })
+
+        documents_fetched.inc( len( results.docs ) )
+
+        for document in results.docs:
+            yield document
+
+        start += page_rows
+
+        if len( results.docs ) < page_rows:
+            break
+
+def get_sampled_word_counts( solr, fq, query, num_words, num_matching_documents, sample_size=None, time_budget=None,
+                             token_filter=None ):
+    """Approximate word counts from a random sample of the matching sentences
+
+    The sample is bounded by sample_size sentences and, if given, by time_budget seconds of fetching.
+    Counts are scaled up to all num_matching_documents sentences. Each word also gets a count_error,
+    the standard error of its scaled count. Returns the words and a dict describing the sample.
+    """
+    start_time = time.time()
+
+    if sample_size is None:
+        sample_size = default_sample_size
+
+    deadline = None
+    if time_budget is not None:
+        deadline = start_time + time_budget
+
+    sampled = [ 0 ]
+    def sentences():
+        for document in fetch_sample( solr, fq, query, sample_size, 'sentence', deadline=deadline ):
+            sampled[ 0 ] += 1
+            yield document[ 'sentence' ].lower()
+
+    print 'calculating sampled non_stemmed_wordcounts'
+    term_counts = streaming_non_stemmed_word_count( sentences(), token_filter=token_filter )
+
+    if '' in term_counts:
+        del term_counts['']
+
+    stem_counts, best_terms = stem_term_counts( term_counts )
+    ret = top_words( stem_counts, best_terms, num_words )
+
+    sample_size = sampled[ 0 ]
+    scale = float( num_matching_documents ) / max( sample_size, 1 )
+    sampling_fraction = min( 1.0, 1.0 / scale ) if scale > 0 else 1.0
+
+    for word in ret:
+        sample_count = word[ 'count' ]
+        word[ 'count' ] = int( round( sample_count * scale ) )
+        # standard error of a scaled count under sampling without replacement
+        word[ 'count_error' ] = int( round( scale * math.sqrt( sample_count * ( 1.0 - sampling_fraction ) ) ) )
+
+    sample = {
+        'sample_size': sample_size,
+        'matching_documents': num_matching_documents,
+        'scale': scale,
+        }
+
+    print "sampled {} of {} sentences in {}".format( sample_size, num_matching_documents, time.time() - start_time )
+
+    return ret, sample
+
 def main():
 
     solr = solr_connection()
@@ -6,27 +6,17 @@ import time
 import csv
 import sys
 import pysolr
+import mc_solr
+import solr_in_memory_wordcount_stemmed
 
-def _fetch_all( solr, query ) :
-    documents = []
-    num_matching_documents = solr.search( query ).hits
-
-    start = 0
-    rows = num_matching_documents
+# number of disjoint sub-queries fetched concurrently
+num_shards = 8
 
+def _fetch_all( solr, query ) :
     sys.stderr.write( ' starting fetch for ' + query )
-    while ( len( documents ) < num_matching_documents ) :
-        results = solr.search( query, **{ 
-                'start': start,
-                'rows': rows,
-               # 'fl' : 'media_id',
-                })
-        documents.extend( results.docs )
-        start += rows
-
-        assert len( documents ) <= num_matching_documents
+    documents = solr_in_memory_wordcount_stemmed.fetch_all_sharded( solr, None, query, num_shards=num_shards )
+    sys.stderr.write( 'fetched {0} documents'.format( len( documents ) ) )
 
-    assert len( documents ) == num_matching_documents
     return documents
 
 def time_to_fetch_all( solr, query ) :
@@ -38,7 +28,7 @@ def time_to_fetch_all( solr, query ) :
 
 url_file = 'urls.txt'
 
-solr = pysolr.Solr('http://localhost:8983/solr/')
+solr = mc_solr.pooled_solr_connection('http://localhost:8983/solr/')
 
 queries = [ 'sentence:obama',
             'sentence:mccain', 
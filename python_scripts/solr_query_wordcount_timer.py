@@ -4,12 +4,31 @@ import ipdb
 #import time
 #import csv
 import sys
+import collections
+import itertools
+import json
 import pysolr
 import dateutil.parser
 import solr_in_memory_wordcount_stemmed
 
 in_memory_word_count_threshold = 10000000
 
+# how queries above in_memory_word_count_threshold are counted: 'in_solr' or 'sample'
+large_query_word_count_method = 'in_solr'
+
+# 'facet' or 'tvrh', see in_solr_word_count()
+in_solr_word_count_method = 'facet'
+
+# number of facet terms read for each requested word, leaving room for terms merged by stemming
+in_solr_facet_terms_per_word = 20
+
+in_solr_facet_page_size = 10000
+
+in_solr_facet_method = 'fc'
+
+# documents per /tvrh request when counting with term vectors
+in_solr_term_vector_rows = 1000
+
 def get_word_counts( solr, query, date_str, num_words=1000 ) :
     documents = []
 
@@ -17,53 +36,190 @@ def get_word_counts( solr, query, date_str, num_words=1000 ) :
 
     return _get_word_counts_impl( solr, fq, num_words )
 
-def get_word_counts_for_service( solr, fq, num_words, q ):
-    return _get_word_counts_impl( solr, fq, num_words, q )
+def get_word_counts_for_service( solr, fq, num_words, q, sample_size=None, time_budget=None,
+                                 languages=None, min_length=None, drop_numeric=False, dedup=None, backend='solr' ):
+    return _get_word_counts_impl( solr, fq, num_words, q, sample_size, time_budget, languages, min_length, drop_numeric, dedup,
+                                  backend )
+
+def get_token_filter( solr, fq, q, languages=None, min_length=None, drop_numeric=False ):
+    """Build the TokenFilter for the given options, or None if no filtering was asked for
+
+    languages is a list of language codes whose stopwords are dropped, or 'auto' to use the languages
+    found in the matching sentences. Either way the sentences are restricted to those languages, so
+    the returned fq includes a language filter query.
+    """
+    if not languages and not min_length and not drop_numeric:
+        return None, fq
+
+    if languages == 'auto':
+        languages = solr_in_memory_wordcount_stemmed.detect_languages( solr, fq, q )
+        print "detected languages: {}".format( languages )
 
-def _get_word_counts_impl( solr, fq, num_words, q ):
+    if languages:
+        if fq is None:
+            fq = []
+        elif isinstance( fq, basestring ):
+            fq = [ fq ]
+
+        fq = fq + [ solr_in_memory_wordcount_stemmed.language_fq( languages ) ]
+
+    token_filter = solr_in_memory_wordcount_stemmed.TokenFilter( languages or (), min_length or 1, drop_numeric )
+
+    return token_filter, fq
+
+def _get_word_counts_impl( solr, fq, num_words, q, sample_size=None, time_budget=None,
+                           languages=None, min_length=None, drop_numeric=False, dedup=None, backend='solr' ):
+    """Returns a dict with the word 'counts' and a 'sample' or 'in_solr' description if they were not counted in memory"""
 
     print int(num_words )
     num_words = min ( int(num_words), 5000 )
 
+    token_filter, fq = get_token_filter( solr, fq, q, languages, min_length, drop_numeric )
+
     print "{0} word will be returned".format( num_words)
+
+    # queries postgres can answer are streamed from story_sentences whatever their size, without asking solr
+    if backend == 'postgres' and sample_size is None and time_budget is None and \
+       solr_in_memory_wordcount_stemmed.sentence_filter_sql( fq, q ) is not None:
+        print "q:{0}, fq:{1} counted from postgres\n".format( q, fq )
+        return { 'counts': in_memory_word_count( solr, fq, num_words, q, token_filter, dedup, backend ) }
+
     matching_documents = solr.search( q, **{ 'fq': fq } ).hits
 
     print "q:{0}, fq:{1} \n".format( q, fq )
 
     print "{0} matching documents ".format( matching_documents )
 
-    if (matching_documents < in_memory_word_count_threshold) and (in_memory_word_count_threshold > 0):
-        return in_memory_word_count(  solr, fq, num_words, q )
+    if sample_size is not None or time_budget is not None:
+        return sampled_word_count( solr, fq, num_words, q, matching_documents, sample_size, time_budget, token_filter )
+    elif (matching_documents < in_memory_word_count_threshold) and (in_memory_word_count_threshold > 0):
+        return { 'counts': in_memory_word_count(  solr, fq, num_words, q, token_filter, dedup ) }
+    elif large_query_word_count_method == 'in_solr':
+        counts, in_solr = in_solr_word_count( solr, fq, num_words, q, token_filter=token_filter )
+        return { 'counts': counts, 'in_solr': in_solr }
     else:
-        raise Exception ("unimplemented")
-        return in_solr_word_count( solr, fq, num_words, q )
+        return sampled_word_count( solr, fq, num_words, q, matching_documents, token_filter=token_filter )
+
+def in_solr_word_count( solr, fq, num_words, q='*:*', method=None, token_filter=None ):
+    """Count words inside Solr, without fetching the sentence text
+
+    With the 'facet' method term counts are read from pages of facet counts on the sentence field,
+    so the cost depends on the vocabulary rather than the number of sentences. Facet counts are a
+    different unit from the in memory counts: they are the number of sentences containing each term,
+    not the number of times it occurs, only the top in_solr_facet_terms_per_word * num_words terms
+    are read, and the terms come from the Solr analyzer, after its stopword filter. The 'tvrh' method
+    instead streams the term vectors of the matching documents, which gives occurrence counts but
+    requires the field to be indexed with termVectors="true".
+
+    Returns the words and a dict describing the method and the unit of the counts.
+    """
+    if method is None:
+        method = in_solr_word_count_method
+
+    if method == 'facet':
+        max_terms = in_solr_facet_terms_per_word * num_words
+        term_counts = _facet_term_counts( solr, fq, q, max_terms )
+        in_solr = { 'method': 'facet', 'count_unit': 'sentences', 'terms_read': max_terms }
+    elif method == 'tvrh':
+        term_counts = _term_vector_term_counts( solr, fq, q )
+        in_solr = { 'method': 'tvrh', 'count_unit': 'occurrences' }
+    else:
+        raise Exception( "unknown in solr word count method '{}'".format( method ) )
 
-def in_solr_word_count( solr, fq, num_words, q='*:*' ):
-    facet_field = "includes"
+    # both methods count the terms produced by the Solr analyzer rather than by the in memory tokenizer
+    in_solr[ 'analyzer' ] = 'solr'
 
-    query_params = { 
-            'facet':"true",
-            "facet.limit": num_words,
-            "facet.field": facet_field,
-            "facet.method":"enum",
-            "fq": fq,
-            }
+    if token_filter is not None:
+        term_counts = token_filter.filter_counts( term_counts )
 
-    #query_params['fq'] = " AND ".join( query_params['fq'] )
+    stem_counts, best_terms = solr_in_memory_wordcount_stemmed.stem_term_counts( term_counts )
 
-    results = solr.search( q, ** query_params)
+    return solr_in_memory_wordcount_stemmed.top_words( stem_counts, best_terms, num_words ), in_solr
 
-    #ipdb.set_trace()
+def _facet_term_counts( solr, fq, q, max_terms, field='sentence' ):
+    term_counts = collections.Counter()
 
-    facets = results.facets['facet_fields']['includes']
+    offset = 0
+    while offset < max_terms:
+        page_size = min( in_solr_facet_page_size, max_terms - offset )
 
-    counts = dict(zip(facets[0::2],facets[1::2]))
+        query_params = {
+                'rows': 0,
+                'facet': 'true',
+                'facet.field': field,
+                'facet.limit': page_size,
+                'facet.offset': offset,
+                'facet.mincount': 1,
+                'facet.sort': 'count',
+                'facet.method': in_solr_facet_method,
+                'fq': fq,
+                }
 
-    return counts
-    
+        results = solr.search( q, **query_params )
+
+        facets = results.facets[ 'facet_fields' ][ field ]
+
+        for term, count in itertools.izip( facets[0::2], facets[1::2] ):
+            term_counts[ term ] += count
+
+        offset += page_size
+
+        if len( facets ) / 2 < page_size:
+            break
+
+    return term_counts
+
+def _term_vector_term_counts( solr, fq, q, field='sentence' ):
+    term_counts = collections.Counter()
+
+    params = {
+        'q': q,
+        'fq': fq,
+        'fl': 'solr_id',
+        'rows': in_solr_term_vector_rows,
+        'sort': solr_in_memory_wordcount_stemmed.cursor_sort,
+        'tv': 'true',
+        'tv.tf': 'true',
+        'tv.fl': field,
+        'wt': 'json',
+        'json.nl': 'map',
+        }
+    params = { k: v for k, v in params.items() if v is not None }
+
+    cursor_mark = '*'
+    while True:
+        params[ 'cursorMark' ] = cursor_mark
+
+        path = 'tvrh/?' + pysolr.safe_urlencode( params, True )
+        response = json.loads( solr._send_request( 'get', path ) )
+
+        for key, term_vector in response.get( 'termVectors', {} ).iteritems():
+            if key in ( 'uniqueKeyFieldName', 'warnings' ):
+                continue
+
+            for term, stats in term_vector.get( field, {} ).iteritems():
+                term_counts[ term ] += stats[ 'tf' ]
+
+        next_cursor_mark = response.get( 'nextCursorMark' )
+        if next_cursor_mark is None:
+            raise Exception( "counting with term vectors needs cursorMark support, Solr 4.7 or later" )
+
+        if next_cursor_mark == cursor_mark:
+            break
+
+        cursor_mark = next_cursor_mark
+
+    return term_counts
+
+def in_memory_word_count( solr, fq, num_words, q, token_filter=None, dedup=None, backend='solr' ):
+    return solr_in_memory_wordcount_stemmed.get_word_counts( solr, fq, q, num_words,'sentence', token_filter=token_filter,
+                                                             dedup=dedup, backend=backend )
+
+def sampled_word_count( solr, fq, num_words, q, matching_documents, sample_size=None, time_budget=None, token_filter=None ):
+    counts, sample = solr_in_memory_wordcount_stemmed.get_sampled_word_counts( solr, fq, q, num_words, matching_documents,
+                                                                               sample_size, time_budget, token_filter )
 
-def in_memory_word_count( solr, fq, num_words, q ):
-    return solr_in_memory_wordcount_stemmed.get_word_counts( solr, fq, q, num_words,'sentence' )
+    return { 'counts': counts, 'sample': sample }
 
 def get_fq(  query ) :
     start_date = dateutil.parser.parse( query['start_date'] )
@@ -104,7 +260,7 @@ def counts_to_db_style( counts ) :
                       
 
 def solr_connection() :
-    return pysolr.Solr('http://localhost:8983/solr/')
+    return solr_in_memory_wordcount_stemmed.solr_connection()
 
 def main():
 
@@ -0,0 +1,313 @@
+#!/usr/bin/python
+
+# Reproducible, offline benchmark of the Solr fetch and word counting path
+#
+# A synthetic sentence corpus is served by a stand-in Solr endpoint running in a separate process, so
+# results do not depend on the contents or load of a real Solr server and can be compared over time.
+# Each corpus size runs in its own process. Per phase timings and peak RSS are written as JSON.
+
+import argparse
+import BaseHTTPServer
+import collections
+import datetime
+import json
+import multiprocessing
+import platform
+import Queue
+import random
+import re
+import resource
+import SocketServer
+import sys
+import time
+import urlparse
+
+import mc_solr
+import solr_in_memory_wordcount_stemmed
+
+default_corpus_sizes = [ 10000, 100000 ]
+
+default_num_words = 500
+
+_vocabulary_size = 50000
+
+_words = [ u'the', u'a', u'obama', u'mccain', u'said', u"it's", u'U.S.', u'president', u'senate', u'vote',
+           u'health-care', u'2013', u'caf\xe9', u'new', u'york', u'reported', u'on', u'monday' ]
+
+_punctuation = [ u'', u'', u'', u',', u'.', u'!', u' -', u'"' ]
+
+_corpus_start_date = datetime.datetime( 2013, 4, 1 )
+
+def generate_sentences( num_sentences, seed=0 ):
+    """Generate a deterministic list of sentences with a Zipf like term distribution"""
+    rng = random.Random( seed )
+
+    vocabulary = _words + [ u'term{}'.format( i ) for i in xrange( _vocabulary_size ) ]
+
+    sentences = []
+    for i in xrange( num_sentences ):
+        words = []
+        for w in xrange( rng.randint( 0, 30 ) ):
+            # log uniform indexes give roughly 1 / rank term frequencies
+            index = int( len( vocabulary ) ** rng.random() ) - 1
+            words.append( vocabulary[ index ] + rng.choice( _punctuation ) )
+
+        sentences.append( rng.choice( [ u'', u'"' ] ) + u' '.join( words ) )
+
+    return sentences
+
+def generate_corpus( num_sentences, seed=0, num_days=30 ):
+    """Generate Solr style story sentence documents spread evenly over num_days"""
+    documents = []
+    for i, sentence in enumerate( generate_sentences( num_sentences, seed ) ):
+        publish_date = _corpus_start_date + datetime.timedelta( days=( i * num_days ) / max( num_sentences, 1 ) )
+        documents.append( {
+            'solr_id': '{:012d}'.format( i ),
+            'stories_id': i,
+            'sentence': sentence,
+            'publish_date': publish_date,
+            } )
+
+    return documents
+
+_term_query_pattern = re.compile( r'^sentence:(\w+)$' )
+
+_date_range_fq_pattern = re.compile( r'^\s*publish_date:([\[{])(\S+) TO (\S+)([\]}])\s*$' )
+
+_stories_id_mod_fq_pattern = re.compile( r'^\{!frange l=(\d+) u=\1\}mod\(stories_id,(\d+)\)$' )
+
+_random_sort_pattern = re.compile( r'^random_(\d+) asc' )
+
+def _parse_date( date_str ):
+    return datetime.datetime.strptime( date_str[ :19 ], '%Y-%m-%dT%H:%M:%S' )
+
+def _document_filter( q, fqs ):
+    filters = []
+
+    match = _term_query_pattern.match( q or '' )
+    if match is not None:
+        term = match.group( 1 ).lower()
+        filters.append( lambda d: term in re.findall( r'\w+', d[ 'sentence' ].lower() ) )
+
+    for fq in fqs:
+        match = _stories_id_mod_fq_pattern.match( fq )
+        if match is not None:
+            remainder, modulus = int( match.group( 1 ) ), int( match.group( 2 ) )
+            filters.append( lambda d, remainder=remainder, modulus=modulus: d[ 'stories_id' ] % modulus == remainder )
+            continue
+
+        match = _date_range_fq_pattern.match( fq )
+        if match is None:
+            continue
+
+        start_inclusive, start, end, end_inclusive = match.groups()
+        start = _parse_date( start ) if start != '*' else datetime.datetime.min
+        end = _parse_date( end ) if end != '*' else datetime.datetime.max
+
+        def in_range( d, start=start, end=end, start_inclusive=start_inclusive == '[', end_inclusive=end_inclusive == ']' ):
+            date = d[ 'publish_date' ]
+            return ( date > start or ( start_inclusive and date == start ) ) and \
+                   ( date < end or ( end_inclusive and date == end ) )
+
+        filters.append( in_range )
+
+    return lambda d: all( f( d ) for f in filters )
+
+class FakeSolrHandler( BaseHTTPServer.BaseHTTPRequestHandler ):
+    """Serves the subset of /select used by the word counting code: q, fq on publish_date ranges and
+    stories_id shards, start, rows, fl, sorting on solr_id or random_*, cursorMark paging and facets on
+    the sentence field"""
+
+    corpus = []
+
+    def do_GET( self ):
+        self._select( urlparse.urlparse( self.path ).query )
+
+    def do_POST( self ):
+        self._select( self.rfile.read( int( self.headers.getheader( 'content-length', 0 ) ) ) )
+
+    def log_message( self, format, *args ):
+        pass
+
+    def _select( self, query_string ):
+        params = urlparse.parse_qs( query_string, keep_blank_values=True )
+
+        def param( name, default=None ):
+            return params.get( name, [ default ] )[ 0 ]
+
+        fqs = [ fq for fq in params.get( 'fq', [] ) if fq != 'None' ]
+        matching = filter( _document_filter( param( 'q' ), fqs ), self.corpus )
+
+        sort = param( 'sort', '' )
+        random_sort = _random_sort_pattern.match( sort )
+        if random_sort is not None:
+            random.Random( int( random_sort.group( 1 ) ) ).shuffle( matching )
+
+        start = int( param( 'start', 0 ) )
+        rows = int( param( 'rows', 10 ) )
+
+        ret = { 'responseHeader': { 'status': 0, 'QTime': 0 } }
+
+        cursor_mark = param( 'cursorMark' )
+        if cursor_mark is not None:
+            if cursor_mark != '*':
+                matching = [ d for d in matching if d[ 'solr_id' ] > cursor_mark ]
+            page = matching[ :rows ]
+            ret[ 'nextCursorMark' ] = page[ -1 ][ 'solr_id' ] if page else cursor_mark
+        else:
+            page = matching[ start:start + rows ]
+
+        fields = param( 'fl' )
+        fields = [ 'solr_id', 'sentence' ] if fields in ( None, 'None' ) else fields.split( ',' )
+        docs = [ { f: d[ f ] for f in fields if f in d } for d in page ]
+
+        ret[ 'response' ] = { 'numFound': len( matching ), 'start': start, 'docs': docs }
+
+        if param( 'facet' ) == 'true':
+            counts = collections.Counter()
+            for d in matching:
+                counts.update( set( re.findall( r'\w+', d[ 'sentence' ].lower() ) ) )
+
+            offset = int( param( 'facet.offset', 0 ) )
+            limit = int( param( 'facet.limit', 100 ) )
+            facets = []
+            for term, count in counts.most_common()[ offset:offset + limit ]:
+                facets.extend( [ term, count ] )
+
+            ret[ 'facet_counts' ] = { 'facet_fields': { param( 'facet.field' ): facets } }
+
+        body = json.dumps( ret )
+
+        self.send_response( 200 )
+        self.send_header( 'Content-Type', 'application/json; charset=utf-8' )
+        self.send_header( 'Content-Length', str( len( body ) ) )
+        self.end_headers()
+        self.wfile.write( body )
+
+class FakeSolrServer( SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer ):
+    daemon_threads = True
+
+def _serve_corpus( corpus_size, seed, port_queue ):
+    FakeSolrHandler.corpus = generate_corpus( corpus_size, seed )
+
+    server = FakeSolrServer( ( '127.0.0.1', 0 ), FakeSolrHandler )
+    port_queue.put( server.server_address[ 1 ] )
+    server.serve_forever()
+
+def start_fake_solr( corpus_size, seed=0 ):
+    """Serve a generated corpus from a child process; returns the process and a pysolr connection"""
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process( target=_serve_corpus, args=( corpus_size, seed, port_queue ) )
+    process.daemon = True
+    process.start()
+
+    port = port_queue.get( timeout=600 )
+
+    return process, mc_solr.pooled_solr_connection( 'http://127.0.0.1:{}/solr/'.format( port ), timeout=600 )
+
+def peak_rss_kb():
+    # ru_maxrss is a lifetime peak, so this is only meaningful inside the fresh process of run_scenarios_isolated();
+    # children covers the pool workers as long as it is read before the stand-in Solr process is reaped
+    return {
+        'self': resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss,
+        'children': resource.getrusage( resource.RUSAGE_CHILDREN ).ru_maxrss,
+        }
+
+def _timed( phases, name, function, *args, **kwargs ):
+    start_time = time.time()
+    ret = function( *args, **kwargs )
+    phases[ name ] = time.time() - start_time
+
+    return ret
+
+def run_scenarios( corpus_size, num_words=default_num_words, seed=0 ):
+    """Time fetch, tokenize, count, stem, top-k and the whole get_word_counts() for one corpus size"""
+    server_process, solr = start_fake_solr( corpus_size, seed )
+
+    try:
+        phases = collections.OrderedDict()
+
+        documents = _timed( phases, 'fetch', list, solr_in_memory_wordcount_stemmed.fetch_all_cursor( solr, None, '*:*', 'sentence' ) )
+        sentences = _timed( phases, 'lowercase', lambda: [ d[ 'sentence' ].lower() for d in documents ] )
+        documents = None
+
+        _timed( phases, 'tokenize', lambda: [ solr_in_memory_wordcount_stemmed.tokenize( s ) for s in sentences ] )
+        term_counts = _timed( phases, 'count', solr_in_memory_wordcount_stemmed.batch_count_terms, sentences )
+        term_counts.pop( '', None )
+
+        # a cold cache, so that every scenario stems the whole vocabulary
+        solr_in_memory_wordcount_stemmed.stem_cache = solr_in_memory_wordcount_stemmed.StemCache()
+        stem_counts, best_terms = _timed( phases, 'stem', solr_in_memory_wordcount_stemmed.stem_term_counts, term_counts )
+        _timed( phases, 'top_k', solr_in_memory_wordcount_stemmed.top_words, stem_counts, best_terms, num_words )
+
+        solr_in_memory_wordcount_stemmed.stem_cache = solr_in_memory_wordcount_stemmed.StemCache()
+        _timed( phases, 'get_word_counts', solr_in_memory_wordcount_stemmed.get_word_counts, solr, None, '*:*', num_words,
+                split_by_day=False )
+
+        return {
+            'corpus_size': corpus_size,
+            'distinct_terms': len( term_counts ),
+            'phases': phases,
+            'peak_rss_kb': peak_rss_kb(),
+            }
+    finally:
+        server_process.terminate()
+        server_process.join()
+
+def _run_scenarios_child( corpus_size, num_words, seed, result_queue ):
+    result_queue.put( run_scenarios( corpus_size, num_words, seed ) )
+
+def run_scenarios_isolated( corpus_size, num_words=default_num_words, seed=0 ):
+    """run_scenarios() in a fresh process, so that its peak RSS does not include earlier corpus sizes"""
+    result_queue = multiprocessing.Queue()
+    process = multiprocessing.Process( target=_run_scenarios_child, args=( corpus_size, num_words, seed, result_queue ) )
+    process.start()
+
+    try:
+        while True:
+            try:
+                return result_queue.get( timeout=1 )
+            except Queue.Empty:
+                if not process.is_alive():
+                    raise Exception( "scenarios for {} sentences exited with code {}".format( corpus_size, process.exitcode ) )
+    finally:
+        process.join()
+
+def main():
+    parser = argparse.ArgumentParser( description='Benchmark Solr fetch and word counting against a synthetic corpus.' )
+    parser.add_argument( '--sizes', default=','.join( str( s ) for s in default_corpus_sizes ),
+                         help='comma separated corpus sizes in sentences' )
+    parser.add_argument( '--num-words', type=int, default=default_num_words )
+    parser.add_argument( '--seed', type=int, default=0 )
+    parser.add_argument( '--output', help='file to write the JSON results to instead of stdout' )
+
+    args = parser.parse_args()
+
+    results = {
+        'started': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'cpus': multiprocessing.cpu_count(),
+        'seed': args.seed,
+        'scenarios': [],
+        }
+
+    for corpus_size in [ int( s ) for s in args.sizes.split( ',' ) ]:
+        print >> sys.stderr, "running scenarios for {} sentences".format( corpus_size )
+
+        # the word counting functions report progress on stdout
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        try:
+            results[ 'scenarios' ].append( run_scenarios_isolated( corpus_size, args.num_words, args.seed ) )
+        finally:
+            sys.stdout = stdout
+
+    output = json.dumps( results, indent=2 )
+    if args.output:
+        with open( args.output, 'w' ) as f:
+            f.write( output + "\n" )
+    else:
+        print output
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,33 @@
 #!/usr/bin/python
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
+import atexit
+import json
+import os
+import signal
+import sys
+import threading
+import mc_cache
+import mc_metrics
 import solr_query_wordcount_timer
+import solr_in_memory_wordcount_stemmed
 import ipdb
 
+# size of the word counting pool shared by all requests; None means one worker per CPU
+worker_pool_processes = None
+
+# number of tasks after which a pool worker is replaced to contain memory growth
+worker_pool_maxtasksperchild = 200
+
+# budget for the serialized JSON held in the /wc result cache
+cache_max_bytes = 256 * 1024 * 1024
+
+# seconds after which a cached /wc result is recomputed
+cache_ttl = 24 * 60 * 60
+
+# term to stem cache persisted across restarts; set to None to disable
+stem_cache_file = os.path.abspath( os.path.join( os.path.dirname( __file__ ), '..', 'data', 'word_count_stem_cache.pickle' ) )
+
 app = Flask(__name__)
 
 solr = solr_query_wordcount_timer.solr_connection()
@@ -20,47 +44,151 @@ def word_count():
     if not num_words:
         num_words = 500
 
+    # request an approximate count from a random sample of at most this many sentences ...
+    sample_size = request.args.get( 'sample_size', type=int )
+
+    # ... or from as many sentences as can be fetched in this many seconds
+    time_budget = request.args.get( 'time_budget', type=float )
+
+    # comma separated language codes whose stopwords are dropped, or 'auto' to detect them
+    languages = request.args.get( 'languages' )
+    if languages and languages != 'auto':
+        languages = languages.split( ',' )
+
+    min_length = request.args.get( 'min_length', type=int )
+
+    drop_numeric = request.args.get( 'drop_numeric' ) in ( '1', 'true' )
+
+    # 'unique' to count each distinct sentence once, 'weighted' to tokenize it once but count every copy
+    dedup = request.args.get( 'dedup' )
+    if dedup not in ( 'unique', 'weighted' ):
+        dedup = None
+
+    # 'postgres' reads the sentences of match all queries with date, media and language filters from story_sentences
+    backend = request.args.get( 'backend', 'solr' )
+    if backend not in ( 'solr', 'postgres' ):
+        backend = 'solr'
+
     print "num_words: {0} q={1} fq={2}".format( num_words, q, fq )
 
-    key = get_key( q, fq, num_words )
+    key = get_key( q, fq, num_words, sample_size, time_budget, languages, min_length, drop_numeric, dedup, backend )
 
     ret = fetch_from_cache( key )
 
     if ret:
         print "Returning from cache with key '{}'".format( key  )
-        return ret
     else:
-        ret = solr_query_wordcount_timer.get_word_counts_for_service( solr, fq, num_words, q )
+        def count_words():
+            ret = solr_query_wordcount_timer.get_word_counts_for_service( solr, fq, num_words, q, sample_size, time_budget,
+                                                                          languages, min_length, drop_numeric, dedup,
+                                                                          backend )
+
+            ret = json.dumps( ret )
+
+            store_in_cache( key, ret )
+
+            return ret
+
+        ret = in_flight.do( key, count_words )
 
-        ret = jsonify( { 'counts': ret } )
+    return Response( ret, mimetype='application/json' )
 
-        store_in_cache( key, ret )
+class _InFlightCall( object ):
+    def __init__( self ):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
 
-        return ret
+class SingleFlight( object ):
+    """Coalesces concurrent calls with the same key into a single call of the function"""
 
-cache = {}
+    def __init__( self ):
+        self._calls = {}
+        self._lock = threading.Lock()
 
-def get_key( q, fq, num_words ):
-    return "q:{}_fq:{}_num_words:{}".format( q, fq, num_words )
+    def do( self, key, function ):
+        """Call function, or wait for the in progress call with the same key, and return its result"""
+        with self._lock:
+            call = self._calls.get( key )
+            is_leader = call is None
+            if is_leader:
+                call = _InFlightCall()
+                self._calls[ key ] = call
+
+        if not is_leader:
+            print "Waiting for in flight request with key '{}'".format( key )
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = function()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[ key ]
+
+            call.done.set()
+
+        return call.result
+
+in_flight = SingleFlight()
+
+# LRU cache of serialized JSON results bounded by total size in bytes and entry age
+cache = mc_cache.LruCache( cache_max_bytes, cache_ttl, unit='bytes' )
+
+def get_key( q, fq, num_words, sample_size=None, time_budget=None, languages=None, min_length=None, drop_numeric=False,
+             dedup=None, backend='solr' ):
+    return "q:{}_fq:{}_num_words:{}_sample_size:{}_time_budget:{}_languages:{}_min_length:{}_drop_numeric:{}_dedup:{}_backend:{}".format(
+        q, fq, num_words, sample_size, time_budget, languages, min_length, drop_numeric, dedup, backend )
 
 def fetch_from_cache( key ) :
-    if key in cache:
-        return cache[ key ]
-    else:
-        return None
+    return cache.get( key )
 
 def store_in_cache( key, value ):
-    cache[key] = value
+    cache.put( key, value )
 
 @app.route('/clear_cache')
 def clear_cache():
     print "Clearing cache"
     cache.clear()
+    solr_in_memory_wordcount_stemmed.day_term_count_cache.clear()
     return "Cache cleared\n"
 
+@app.route('/cache_stats')
+def cache_stats():
+    stats = cache.stats()
+    stats[ 'day_term_counts' ] = solr_in_memory_wordcount_stemmed.day_term_count_cache.stats()
+    return jsonify( stats )
+
+@app.route('/metrics')
+def metrics():
+    return Response( mc_metrics.render_prometheus(), mimetype='text/plain; version=0.0.4' )
+
 @app.route('/')
 def index():
     return "Hello, World!"
 
+def _save_stem_cache():
+    print "Saving stem cache to {}".format( stem_cache_file )
+    solr_in_memory_wordcount_stemmed.stem_cache.save( stem_cache_file )
+
+def _exit_on_sigterm( signum, frame ):
+    sys.exit( 0 )
+
 if __name__ == '__main__':
-    app.run(debug = False )
+    solr_in_memory_wordcount_stemmed.start_worker_pool( processes=worker_pool_processes,
+                                                        maxtasksperchild=worker_pool_maxtasksperchild )
+    atexit.register( solr_in_memory_wordcount_stemmed.stop_worker_pool )
+
+    if stem_cache_file:
+        solr_in_memory_wordcount_stemmed.stem_cache.load( stem_cache_file )
+        atexit.register( _save_stem_cache )
+
+    signal.signal( signal.SIGTERM, _exit_on_sigterm )
+
+    app.run(debug = False, threaded = True )
@@ -0,0 +1,59 @@
+#!/usr/bin/python
+
+# Micro-benchmark comparing batch_count_terms() with counting tokenize() of each sentence
+
+import argparse
+import collections
+import time
+
+import solr_in_memory_wordcount_stemmed
+from word_count_benchmark import generate_sentences
+
+def tokenize_and_count( sentences ):
+    freq = collections.Counter()
+    for sentence in sentences:
+        freq.update( solr_in_memory_wordcount_stemmed.tokenize( sentence ) )
+
+    return freq
+
+def time_it( function, sentences, repetitions ):
+    best = None
+    for i in xrange( repetitions ):
+        start_time = time.time()
+        result = function( sentences )
+        elapsed = time.time() - start_time
+        best = elapsed if best is None else min( best, elapsed )
+
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser( description='Benchmark the batch tokenizer against per sentence tokenizing.' )
+    parser.add_argument( '--sentences', type=int, default=200000 )
+    parser.add_argument( '--repetitions', type=int, default=3 )
+
+    args = parser.parse_args()
+
+    sentences = generate_sentences( args.sentences )
+
+    candidates = [ ( 'tokenize + Counter', tokenize_and_count ),
+                   ( 'batch_count_terms', solr_in_memory_wordcount_stemmed.batch_count_terms ) ]
+
+    if solr_in_memory_wordcount_stemmed.numpy is not None:
+        candidates.append( ( 'batch_count_terms hashed',
+                             lambda s: solr_in_memory_wordcount_stemmed.batch_count_terms( s, hashed=True ) ) )
+
+    baseline_time = None
+    baseline_counts = None
+    for name, function in candidates:
+        elapsed, counts = time_it( function, sentences, args.repetitions )
+
+        if baseline_counts is None:
+            baseline_time = elapsed
+            baseline_counts = counts
+
+        assert counts == baseline_counts, "{} counts differ from tokenize + Counter".format( name )
+
+        print "{:<28} {:8.3f}s {:6.2f}x".format( name, elapsed, baseline_time / elapsed )
+
+if __name__ == "__main__":
+    main()